@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Thin entry point: forwards the command line to the repository's gomp
+# daemon when one is running, and only imports gomp itself to run the
+# command in-process otherwise. Keep the imports here minimal, they are
+# paid on every command.
+
+from contextlib import contextmanager
+import json
+import os
+import socket
+import sys
+
+daemon_socket = 'gomp-daemon.sock'
+
+
+# The git directory of the working tree around the working directory: its
+# .git directory, or the one the .git file of a linked worktree points to.
+# Found without running git, None if there is none.
+def worktree_git_dir():
+    if 'GIT_DIR' in os.environ:
+        return None
+    directory = os.getcwd()
+    while not os.path.exists(os.path.join(directory, '.git')):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    path = os.path.join(directory, '.git')
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            line = f.readline().strip()
+        if not line.startswith('gitdir:'):
+            return None
+        path = os.path.join(directory, line[len('gitdir:') :].strip())
+    return path
+
+
+# Where the daemon serving the working tree around the working directory
+# listens. Each worktree has its own daemon, as they have their own HEAD.
+def daemon_socket_path():
+    git_dir = worktree_git_dir()
+    return os.path.join(git_dir, daemon_socket) if git_dir else None
+
+
+# The socket of a daemon serving the working tree around the working
+# directory, if there is one
+def find_daemon_socket():
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    path = daemon_socket_path()
+    return path if path is not None and os.path.exists(path) else None
+
+
+# Where $GOMP_PROFILE sends the profile: '-' (stderr) for the usual truthy
+# spellings, the value itself when it looks like a file path (contains a path
+# separator or ends in .json), '' (no profile) otherwise
+def profile_setting():
+    value = os.environ.get('GOMP_PROFILE', '').strip()
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return '-'
+    if '/' in value or os.sep in value or value.endswith('.json'):
+        return value
+    return ''
+
+
+# Connect to a daemon socket, returns None if no daemon is listening
+def query_daemon_socket(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+# Have the repository's daemon run a command and stream its output to
+# stdout. The daemon answers with a JSON header line, either the pager to
+# page the output through or a request to run the command in-process.
+# Returns False when the command wasn't run.
+def query_daemon(argv):
+    # Profiles are only taken in-process
+    if profile_setting():
+        return False
+    path = find_daemon_socket()
+    client = query_daemon_socket(path) if path is not None else None
+    if client is None:
+        return False
+    try:
+        columns = os.get_terminal_size().columns
+    except OSError:
+        columns = None
+    request = {
+        'argv': argv,
+        'terminal': sys.stdout.isatty(),
+        'columns': columns,
+        'environment': {
+            name: os.environ[name]
+            for name in ('GIT_PAGER', 'PAGER')
+            if name in os.environ
+        },
+    }
+    with client:
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = client.makefile('r', encoding='utf-8')
+        header = json.loads(response.readline() or '{"local": true}')
+        if header.get('local'):
+            return False
+        with paging(header.get('pager')):
+            for line in response:
+                sys.stdout.write(line)
+    return True
+
+
+# Send stdout through a pager while the block runs. Output is line buffered
+# so rows show up as they're rendered, and quitting the pager early just
+# stops gomp.
+@contextmanager
+def paging(pager):
+    if not pager or pager == 'cat':
+        yield
+        return
+    import subprocess
+
+    env = dict(os.environ)
+    env.setdefault('LESS', 'FRX')
+    env.setdefault('LV', '-c')
+    process = subprocess.Popen(
+        pager,
+        shell=True,
+        stdin=subprocess.PIPE,
+        universal_newlines=True,
+        bufsize=1,
+        env=env,
+    )
+    stdout = sys.stdout
+    sys.stdout = process.stdin
+    try:
+        yield
+    except BrokenPipeError:
+        # The pager was closed before reading everything
+        pass
+    finally:
+        sys.stdout = stdout
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+
+def main():
+    try:
+        if query_daemon(sys.argv[1:]):
+            return
+        if __package__:
+            from .gomp import process_commands
+        else:
+            from gomp import process_commands
+        process_commands(forward=False)
+    except BrokenPipeError:
+        # The reader stopped early (e.g. `gomp ... | head`), don't fail
+        # again when stdout is flushed on exit
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if os.name == 'nt':
+        os.system('color')
+    main()
@@ -15,20 +15,140 @@
 
 import os
 import re
-from subprocess import run, PIPE
+import glob
+import zlib
+from subprocess import PIPE
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 import argparse
+import bisect
+import io
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import json
+import threading
+import time
+import tracemalloc
+import heapq
+import mmap
 import platform
+import struct
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if __package__:
+    from .client import daemon_socket_path, paging as pipe_to_pager
+    from .client import profile_setting, query_daemon, query_daemon_socket
+else:
+    from client import daemon_socket_path, paging as pipe_to_pager
+    from client import profile_setting, query_daemon, query_daemon_socket
 
 #############
 ### ENUMS ###
 #############
 
-# pylint: disable=global-statement
 class Commands:
     show_side_by_side = 'show side by side'
     offset_recut = 'offer recut'
 
 
+class Match:
+    title = 'title'
+    patch_id = 'patch-id'
+
+
+# How both columns are computed: by walking both histories and matching
+# commits in gomp, from a single `git log --cherry-mark` walk of the
+# symmetric difference (commits are then matched by patch-id, by git), or by
+# letting git walk both branches down to their merge-base (see
+# read_dag_histories). The rewrite engine compares a branch before and after
+# it was rewritten (see read_rewrite_rows).
+class Engine:
+    walk = 'walk'
+    cherry_mark = 'cherry-mark'
+    dag = 'dag'
+    rewrite = 'rewrite'
+
+
+class Format:
+    text = 'text'
+    json = 'json'
+    ndjson = 'ndjson'
+
+
+class Status:
+    common = 'common'
+    similar = 'similar'
+    src_new = 'src_new'
+    dest_new = 'dest_new'
+    # A similar commit out of order with the other branch (see align_rows)
+    moved = 'moved'
+
+
+# How a commit changed when its branch was rewritten (see pair_rewrites)
+class Rewrite:
+    unchanged = 'unchanged'
+    reworded = 'reworded'
+    content_changed = 'content-changed'
+    added = 'added'
+    dropped = 'dropped'
+
+
+# A commit as shown in a comparison. `duplicate` marks titles that appear more
+# than once in the branch, which are displayed suffixed with their hash.
+# `similarity` scores commits matched by a reworded title (see
+# match_fuzzy_rows), it is None otherwise. `contained_in` names the refs
+# containing the commit with --contained-in (see annotate_containing_refs).
+# Comparing a rewritten branch, `rewrite` says how the commit changed and
+# `pair` is the hash of its old or new version (see read_rewrite_rows).
+Row = namedtuple(
+    'Row',
+    [
+        'hash',
+        'title',
+        'status',
+        'duplicate',
+        'similarity',
+        'contained_in',
+        'rewrite',
+        'pair',
+    ],
+    defaults=[None, None, None, None],
+)
+
+# How a branch compares to a base branch: the number of commits only on the
+# branch (ahead), only on the base (behind), and how many of the commits
+# ahead match a base commit (similar)
+BranchSummary = namedtuple(
+    'BranchSummary', ['branch', 'ahead', 'behind', 'similar']
+)
+
+# Commit counts of a comparison: only on src, only on dest, patch-equivalent
+# on both sides, and the first-parent depth of dest below its tip at which
+# it joins the history of src
+Stat = namedtuple('Stat', ['src_new', 'dest_new', 'similar', 'depth'])
+# The last result of comparing two branches, see HistoryComparison.diff_lists
+ComparisonResult = namedtuple(
+    'ComparisonResult',
+    ['source_hash', 'destination_hash', 'source_rows', 'destination_rows'],
+)
+
+
+class Prediction:
+    clean = 'clean'
+    conflict = 'conflict'
+    # An earlier pick changing the same files conflicted
+    unknown = 'unknown'
+
+
 class BColors:
     # pylint: disable=invalid-name
     WHITE = '\033[37m'
@@ -37,6 +157,7 @@ class BColors:
     SRC_NEW = '\033[95m'
     DEST_NEW = '\033[91m'
     SIMILAR = '\033[93m'
+    MOVED = '\033[96m'
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
     ENDC = '\033[0m'
@@ -51,17 +172,24 @@ def colorize(text, color):
     return color + text + BColors.ENDC
 
 
+status_colors = {
+    Status.common: BColors.COMMON,
+    Status.similar: BColors.SIMILAR,
+    Status.src_new: BColors.SRC_NEW,
+    Status.dest_new: BColors.DEST_NEW,
+    Status.moved: BColors.MOVED,
+}
+
+
 # Converts text-only history to (hash, title) tuples
 def process_history(hist):
-    # pylint: disable=consider-using-enumerate
-    for i in range(len(hist)):
-        _hash = hist[i][0:40]
-        _title = hist[i][41:]
-        hist[i] = [_hash, _title]
-    return hist
+    history = History()
+    history.hashes += bytes.fromhex(''.join([line[0:40] for line in hist]))
+    history.titles = [line[41:] for line in hist]
+    return history
 
 
-def format_lint(line, width=0):
+def format_lint(line, width):
     text = line[0]
     color = BColors.WHITE
     if len(line) == 2:
@@ -69,63 +197,394 @@ def format_lint(line, width=0):
     return colorize(fix_text_length(text, width), color)
 
 
-def fix_text_length(text, width=0):
-    if width == 0:
-        width = int(line_length / 2 - 1)
+def fix_text_length(text, width):
     return ('{:<' + str(width) + '}').format(text[:width])
 
 
+# Width of one side of the side by side view
+def column_width(line_length):
+    return int(line_length / 2 - 1)
+
+
+# Short hash and title of a row, with duplicated titles suffixed by hash, how
+# rewritten commits changed, the similarity of fuzzy matches and the refs
+# containing the commit
+def row_text(row, hash_length):
+    text = row.hash[0:hash_length] + ' '
+    # Shown up front so that long titles don't cut them off
+    if row.rewrite is not None:
+        text += '[{}] '.format(row.rewrite)
+    if row.similarity is not None:
+        text += '~{:.0%} '.format(row.similarity)
+    if row.contained_in:
+        text += '({}) '.format(', '.join(row.contained_in))
+    text += row.title
+    if row.duplicate:
+        text += ' - ' + row.hash[0:hash_length]
+    return text
+
+
 # Display color key
-def print_color_key(source='src', destination='dest'):
+def print_color_key(source='src', destination='dest', aligned=False):
     print(colorize('Common commit', BColors.COMMON))
     print(colorize('Similar commit', BColors.SIMILAR))
+    if aligned:
+        print(colorize('Moved commit', BColors.MOVED))
     print(colorize('Unique {} commit'.format(source), BColors.SRC_NEW))
     print(colorize('Unique {} commit'.format(destination), BColors.DEST_NEW))
     print('')
 
 
 hash_length = 7
-line_length = 80
+recut_hash_length = 16
 branch_name_length = 10
-src = None
-dest = None
-source_history = None
-destination_history = None
+trailing_rows = 5
+
+#################
+### PROFILING ###
+#################
+
+
+# Per-stage wall and CPU time, commit counts, subprocesses and peak memory of
+# a gomp run (see --profile). Stages run on several threads, so CPU time is
+# measured per thread; the CPU time of git itself is reported as a total.
+# Stage times include any stage nested in them.
+class Profile:
+    def __init__(self):
+        self.stages = {}
+        self.subprocesses = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.times = os.times()
+        self.report = None
+        tracemalloc.start()
+
+    def stage(self, name):
+        return self.stages.setdefault(
+            name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'commits': 0}
+        )
+
+    def add_stage(self, name, wall, cpu):
+        with self.lock:
+            stage = self.stage(name)
+            stage['calls'] += 1
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+
+    def add_commits(self, name, count):
+        with self.lock:
+            self.stage(name)['commits'] += count
+
+    def add_subprocess(self, command, size):
+        with self.lock:
+            entry = self.subprocesses.setdefault(
+                command, {'count': 0, 'bytes': 0}
+            )
+            entry['count'] += 1
+            entry['bytes'] += size
+
+    def add_bytes(self, command, size):
+        with self.lock:
+            self.subprocesses[command]['bytes'] += size
+
+    def stop(self):
+        times = os.times()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = self.times
+        self.report = {
+            'wall': time.perf_counter() - self.started,
+            'cpu': times.user + times.system - start.user - start.system,
+            'git_cpu': max(
+                0.0,
+                times.children_user
+                + times.children_system
+                - start.children_user
+                - start.children_system,
+            ),
+            'peak_memory': peak,
+            'stages': self.stages,
+            'subprocesses': self.subprocesses,
+        }
+        return self.report
+
+    def write(self, path):
+        if path != '-':
+            with open(path, 'w') as f:
+                json.dump(self.report, f, indent=2)
+                f.write('\n')
+            return
+        report = self.report
+        lines = [
+            '{:<14}{:>6}{:>10}{:>10}{:>10}'.format(
+                'Stage', 'Calls', 'Wall ms', 'CPU ms', 'Commits'
+            )
+        ]
+        for name, stage in report['stages'].items():
+            lines.append(
+                '{:<14}{:>6}{:>10.1f}{:>10.1f}{:>10}'.format(
+                    name,
+                    stage['calls'],
+                    stage['wall'] * 1000,
+                    stage['cpu'] * 1000,
+                    stage['commits'],
+                )
+            )
+        lines.append('')
+        lines.append('{:<20}{:>6}{:>14}'.format('Subprocess', 'Count', 'Bytes'))
+        for command, entry in report['subprocesses'].items():
+            lines.append(
+                '{:<20}{:>6}{:>14}'.format(
+                    command, entry['count'], entry['bytes']
+                )
+            )
+        lines.append('')
+        lines.append(
+            'Total {:.1f} ms wall, {:.1f} ms CPU, {:.1f} ms git CPU, '
+            'peak memory {} KiB'.format(
+                report['wall'] * 1000,
+                report['cpu'] * 1000,
+                report['git_cpu'] * 1000,
+                report['peak_memory'] // 1024,
+            )
+        )
+        print('\n'.join(lines), file=sys.stderr)
+
+
+# The profile being collected, if any
+active_profile = None
+
+
+# Collect a profile of everything run in the block, then write it to `path`
+# (a JSON file, or '-' for a summary on stderr). Does nothing without a path.
+@contextmanager
+def profiling(path):
+    global active_profile  # pylint: disable=global-statement
+    if not path:
+        yield
+        return
+    active_profile = Profile()
+    try:
+        yield
+    finally:
+        profile, active_profile = active_profile, None
+        profile.stop()
+        profile.write(path)
+
+
+@contextmanager
+def profile_stage(name):
+    if active_profile is None:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        active_profile.add_stage(
+            name, time.perf_counter() - wall, time.thread_time() - cpu
+        )
+
+
+def profile_commits(name, count):
+    if active_profile is not None:
+        active_profile.add_commits(name, count)
+
+
+# Name of a git command for the profile, e.g. `git log`
+def command_name(args):
+    words = [arg for arg in args[1:] if not arg.startswith('-')]
+    return ' '.join(args[:1] + words[:1])
+
+
+# subprocess.run, accounted for in the active profile
+def run(args, **kwargs):
+    # pylint: disable=subprocess-run-check
+    result = subprocess.run(args, **kwargs)
+    if active_profile is not None:
+        output = result.stdout if result.stdout is not None else ''
+        active_profile.add_subprocess(command_name(args), byte_size(output))
+    return result
+
+
+# Size in bytes of the output of a subprocess, read as bytes or as text
+def byte_size(output):
+    if isinstance(output, str):
+        return len(output.encode('utf-8', 'surrogateescape'))
+    return len(output)
+
+
+# subprocess.Popen, accounted for in the active profile. Bytes read from
+# the pipe are counted by profile_output.
+def Popen(args, **kwargs):  # pylint: disable=invalid-name
+    if active_profile is not None:
+        active_profile.add_subprocess(command_name(args), 0)
+    return subprocess.Popen(args, **kwargs)
+
+
+# Pass lines read from a subprocess through, counting their size
+def profile_output(args, lines):
+    if active_profile is None:
+        yield from lines
+        return
+    command = command_name(args)
+    for line in lines:
+        active_profile.add_bytes(command, byte_size(line))
+        yield line
+
+###############
+### HISTORY ###
+###############
+
+
+# The commits of a branch in `git log` order. Full histories can be hundreds
+# of thousands of commits long, so hashes are stored as 20-byte binary in one
+# bytearray next to a list of titles. Indexing and iterating give [hash, title]
+# commits, which are only built for the rows that are looked at.
+class History:
+    __slots__ = ('hashes', 'titles')
+
+    def __init__(self, commits=()):
+        self.hashes = bytearray()
+        self.titles = []
+        self.extend(commits)
+
+    def append(self, _hash, _title):
+        self.hashes += bytes.fromhex(_hash)
+        self.titles.append(_title)
+
+    # Append [hash, title] commits, converting all hashes at once
+    def extend(self, commits):
+        hashes = []
+        for commit in commits:
+            hashes.append(commit[0])
+            self.titles.append(commit[1])
+        self.hashes += bytes.fromhex(''.join(hashes))
+
+    def __len__(self):
+        return len(self.titles)
+
+    # Newer commits on top of an older history
+    def __add__(self, older):
+        history = History()
+        history.hashes = self.hashes + older.hashes
+        history.titles = self.titles + older.titles
+        return history
+
+    def __getitem__(self, i):
+        _title = self.titles[i]
+        if i < 0:
+            i += len(self.titles)
+        return [self.hash(i), _title]
+
+    def __iter__(self):
+        for i in range(len(self.titles)):
+            yield self[i]
+
+    def hash(self, i):
+        return self.hashes[20 * i : 20 * i + 20].hex()
+
+    # Position of a hash in the history, raises ValueError if it's not there
+    def index(self, _hash):
+        key = bytes.fromhex(_hash)
+        position = self.hashes.find(key)
+        while position != -1 and position % 20:
+            position = self.hashes.find(key, position + 1)
+        if position == -1:
+            raise ValueError('{} is not in the history'.format(_hash))
+        return position // 20
+
 
 #####################
 ### HEAVY LIFITNG ###
 #####################
 
 
-def create_title_map(commits, end_hash=None):
+# The key used to match commits across histories: the title by default, or
+# e.g. the patch-id of the change when `keys` maps hashes to other keys
+def match_key(commit, keys=None):
+    if keys is None:
+        return commit[1]
+    return keys.get(commit[0], commit[0])
+
+
+# Maps match keys to positions in the history, and returns the key of every
+# commit alongside. Positions count from the oldest commit, so that they still
+# hold once newer commits are added on top (see extend_title_map). Histories
+# are not modified, so they can be shared between comparisons.
+def create_title_map(commits, keys=None):
     title_map = {}
+    commit_keys = []
     # Note: we must compute the entire history of commit name-mapping here
     # to account for highly divergent branches. This could maybe be more clever.
-    for commit in commits:
-        # If there are conflicting titles, suffix them with hash
-        if commit[1] in title_map:
-            commit[1] = commit[1] + ' - ' + commit[0][0:hash_length]
-        # Map titles to hashes
-        title_map[commit[1]] = commit[0]
-    return title_map
+    with profile_stage('title_map'):
+        if keys is None:
+            commit_keys = list(commits.titles)
+        else:
+            commit_keys = [match_key(commit, keys) for commit in commits]
+        last = len(commit_keys) - 1
+        for i, key in enumerate(commit_keys):
+            # If there are conflicting titles, pair them with the hash
+            if key in title_map:
+                key = (key, commits.hash(i))
+                commit_keys[i] = key
+            # Map titles to commits
+            title_map[key] = last - i
+    profile_commits('title_map', len(commit_keys))
+    return title_map, commit_keys
+
 
+# Extends the title map of a history to the same history with `count` newer
+# commits on top, without going through the older commits again. Returns the
+# title map and keys, and the set of keys whose commit changed: the keys of
+# the new commits, and those of older commits whose title a newer commit now
+# takes over.
+def extend_title_map(title_map, commit_keys, history, count):
+    with profile_stage('title_map'):
+        title_map = dict(title_map)
+        commit_keys = [None] * count + commit_keys
+        changed = set()
+        last = len(history) - 1
+        for i in range(count):
+            key = history.titles[i]
+            if key in title_map:
+                position = title_map[key]
+                if position > last - count:
+                    key = (key, history.hash(i))
+                else:
+                    # Newest commit first, the older one is paired with its hash
+                    older = (key, history.hash(last - position))
+                    title_map[older] = position
+                    commit_keys[last - position] = older
+                    changed.add(older)
+            title_map[key] = last - i
+            commit_keys[i] = key
+            changed.add(key)
+    profile_commits('title_map', count)
+    return (title_map, commit_keys), changed
 
-# Finds the first common hash between two histories
+
+# Finds the first common hash between two histories. Commits are pulled from
+# both sides in lockstep, so lazily-read histories stop at the common hash.
 def find_first_common_hash(source_commit, destination_commit, previous=0):
     source_map = {}
     destination_map = {}
+    source_commit = iter(source_commit)
+    destination_commit = iter(destination_commit)
 
-    index = 0
     while True:
-        source_in_bound = index < len(source_commit)
-        dest_in_bound = index < len(destination_commit)
+        source_row = next(source_commit, None)
+        dest_row = next(destination_commit, None)
+        source_in_bound = source_row is not None
+        dest_in_bound = dest_row is not None
 
         if source_in_bound:
-            hash_source = source_commit[index][0]
+            hash_source = source_row[0]
             source_map[hash_source] = True
 
         if dest_in_bound:
-            hash_dest = destination_commit[index][0]
+            hash_dest = dest_row[0]
             destination_map[hash_dest] = True
 
         # Are we out of runway?
@@ -137,41 +596,63 @@ def find_first_common_hash(source_commit, destination_commit, previous=0):
             return hash_dest
         if source_in_bound and hash_source in destination_map:
             return hash_source
-        index += 1
 
 
-# Returns a list of hash + title paired with color code
+# The status of a commit in both branches, from its match key. `histories`
+# are the (source, destination) histories the title maps point into.
+def classify_commit(_key, source_title_map, destination_title_map, histories):
+    source_history, destination_history = histories
+    exists_in_source = _key in source_title_map
+    exists_in_destination = _key in destination_title_map
+    exists_in_both = exists_in_source and exists_in_destination
+    same_commit = exists_in_both and source_history.hash(
+        len(source_history) - 1 - source_title_map[_key]
+    ) == destination_history.hash(
+        len(destination_history) - 1 - destination_title_map[_key]
+    )
+
+    # Color code outputs based on existence in branches
+    if same_commit:
+        return Status.common
+    if exists_in_both:
+        return Status.similar
+    if exists_in_destination:
+        return Status.dest_new
+    if exists_in_source:
+        return Status.src_new
+    raise Exception('https://xkcd.com/2200/')
+
+
+# Returns a list of rows, with their status in both branches. Rows of a
+# previous comparison can be passed as `previous` ({hash: row}, changed keys):
+# they are reused unless the title maps changed for their key.
 def construct_diff_list(
-    commits, source_title_map, destination_title_map, end_hash
+    commits,
+    commit_keys,
+    source_title_map,
+    destination_title_map,
+    end_hash,
+    histories,
+    previous=None,
 ):
+    # pylint: disable=too-many-arguments,too-many-locals
+    previous_rows, changed_keys = previous if previous else ({}, ())
     i = 0
-    trailing_rows = 5
+    remaining_rows = trailing_rows
     count_down_trailing_rows = False
     rows = []
     # Print until matching hash found
-    while trailing_rows > 0:
-        row = commits[i]
-        _hash = row[0]
-        _title = row[1]
-        exists_in_source = _title in source_title_map
-        exists_in_destination = _title in destination_title_map
-        exists_in_both = exists_in_source and exists_in_destination
-        same_commit = (
-            exists_in_both
-            and source_title_map[_title] == destination_title_map[_title]
-        )
-
-        # Color code outputs based on existence in branches
-        if same_commit:
-            rows.append([_hash[0:hash_length] + ' ' + _title, BColors.COMMON])
-        elif exists_in_both:
-            rows.append([_hash[0:hash_length] + ' ' + _title, BColors.SIMILAR])
-        elif exists_in_destination:
-            rows.append([_hash[0:hash_length] + ' ' + _title, BColors.DEST_NEW])
-        elif exists_in_source:
-            rows.append([_hash[0:hash_length] + ' ' + _title, BColors.SRC_NEW])
-        else:
-            raise Exception('https://xkcd.com/2200/')
+    while remaining_rows > 0:
+        _hash = commits.hash(i)
+        _key = commit_keys[i]
+        row = previous_rows.get(_hash)
+        if row is None or _key in changed_keys:
+            status = classify_commit(
+                _key, source_title_map, destination_title_map, histories
+            )
+            _title = commits.titles[i]
+            row = Row(_hash, _title, status, isinstance(_key, tuple))
+        rows.append(row)
 
         # If there are no more commits, we're done
         i += 1
@@ -182,210 +663,3510 @@ def construct_diff_list(
         if _hash == end_hash:
             count_down_trailing_rows = True
         elif count_down_trailing_rows:
-            trailing_rows -= 1
+            remaining_rows -= 1
 
     return rows
 
 
-# Print the history side by side until (and including) the given hash
-def compute_side_by_side(commits_source, commits_destination, _hash):
+# Compute the rows of both branches until (and including) the given hash
+# Title maps that were already built (see create_title_map) can be passed
+# as ((source map, source keys), (destination map, destination keys)), and
+# rows that can be reused as ((source rows, destination rows), changed keys)
+# (see construct_diff_list).
+def compute_diff_lists(
+    commits_source,
+    commits_destination,
+    _hash,
+    keys=None,
+    title_maps=None,
+    previous=None,
+):
+    # pylint: disable=too-many-arguments
     # Compute the existing commits and title elements
-    source_title_map = create_title_map(commits_source, _hash)
-    destination_title_map = create_title_map(commits_destination, _hash)
-    # Pretty-print the two histories side by side (common hashes aligned)
-    source_diff_list = construct_diff_list(
-        commits_source, source_title_map, destination_title_map, _hash
-    )
-    destination_diff_list = construct_diff_list(
-        commits_destination, source_title_map, destination_title_map, _hash
+    if title_maps is None:
+        title_maps = (
+            create_title_map(commits_source, keys),
+            create_title_map(commits_destination, keys),
+        )
+    source_title_map, source_keys = title_maps[0]
+    destination_title_map, destination_keys = title_maps[1]
+    source_previous = destination_previous = None
+    if previous is not None:
+        (source_rows, destination_rows), changed_keys = previous
+        source_previous = ({row.hash: row for row in source_rows}, changed_keys)
+        destination_previous = (
+            {row.hash: row for row in destination_rows},
+            changed_keys,
+        )
+    with profile_stage('diff'):
+        source_diff_list = construct_diff_list(
+            commits_source,
+            source_keys,
+            source_title_map,
+            destination_title_map,
+            _hash,
+            (commits_source, commits_destination),
+            source_previous,
+        )
+        destination_diff_list = construct_diff_list(
+            commits_destination,
+            destination_keys,
+            source_title_map,
+            destination_title_map,
+            _hash,
+            (commits_source, commits_destination),
+            destination_previous,
+        )
+    profile_commits('diff', len(source_diff_list) + len(destination_diff_list))
+    return source_diff_list, destination_diff_list
+
+
+# Compute the rows of a DAG walk (see read_dag_histories) of both branches
+# until (and including) their merge-base. Commits are classified against
+# the (source, destination) histories that the title maps are built from,
+# e.g. the full histories, of which the rows are only a part.
+def compute_dag_diff_lists(rows, histories, _hash, keys=None, title_maps=None):
+    if title_maps is None:
+        title_maps = (
+            create_title_map(histories[0], keys),
+            create_title_map(histories[1], keys),
+        )
+    source_title_map = title_maps[0][0]
+    destination_title_map = title_maps[1][0]
+    diff_lists = []
+    with profile_stage('diff'):
+        for commits, history, (_, commit_keys) in zip(
+            rows, histories, title_maps
+        ):
+            row_keys = [
+                commit_keys[history.index(commits.hash(i))]
+                for i in range(len(commits))
+            ]
+            diff_lists.append(
+                construct_diff_list(
+                    commits,
+                    row_keys,
+                    source_title_map,
+                    destination_title_map,
+                    _hash,
+                    histories,
+                )
+            )
+    profile_commits('diff', len(diff_lists[0]) + len(diff_lists[1]))
+    return diff_lists[0], diff_lists[1]
+
+
+# Pair up the history side by side until (and including) the given hash.
+# Returns (source row, destination row) pairs, blank sides are None.
+def compute_side_by_side(
+    commits_source, commits_destination, _hash, keys=None, title_maps=None
+):
+    source_diff_list, destination_diff_list = compute_diff_lists(
+        commits_source, commits_destination, _hash, keys, title_maps
     )
+    return list(pair_rows(source_diff_list, destination_diff_list))
+
+
+# Pair up rows of both branches, aligned on their last (oldest) rows. Pairs
+# are generated as they are consumed, so the first ones can be shown while
+# the rest are still being formatted.
+def pair_rows(source_diff_list, destination_diff_list):
+    # Pretty-print the two histories side by side (common hashes aligned)
     source_length = len(source_diff_list)
     destination_length = len(destination_diff_list)
     source_offset = max(destination_length - source_length, 0)
     destination_offset = max(source_length - destination_length, 0)
-    side_by_side = []
     i = 0
     while i < max(source_length, destination_length):
-        left_text = format_lint([''])
-        right_text = format_lint([''])
+        left = None
+        right = None
         if i - source_offset >= 0:
-            left_text = format_lint(source_diff_list[i - source_offset])
+            left = source_diff_list[i - source_offset]
         if i - destination_offset >= 0:
-            right_text = format_lint(
-                destination_diff_list[i - destination_offset]
-            )
+            right = destination_diff_list[i - destination_offset]
         i += 1
-        side_by_side.append(left_text + '  ' + right_text)
-    return side_by_side
+        yield left, right
+
+
+# Positions of one of the longest strictly increasing subsequences of
+# `sequence`, in O(n log n) by patience sorting: `tails[k]` is the smallest
+# value that ends an increasing subsequence of length k + 1 so far.
+def longest_increasing_subsequence(sequence):
+    tails = []
+    tail_positions = []
+    predecessors = []
+    for i, value in enumerate(sequence):
+        k = bisect.bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_positions.append(i)
+        else:
+            tails[k] = value
+            tail_positions[k] = i
+        predecessors.append(tail_positions[k - 1] if k else None)
+    subsequence = []
+    i = tail_positions[-1] if tail_positions else None
+    while i is not None:
+        subsequence.append(i)
+        i = predecessors[i]
+    return subsequence[::-1]
 
 
-# Print the recut offer given a common hash
-def compute_recut_offer(commits_source, commits_destination, _hash):
+# Pair up rows of both branches so that matching commits (by match key, see
+# match_key) share a line. Of the commits listed on both sides, the most that
+# are in the same order on both are aligned: a longest increasing subsequence
+# of their destination positions, taken in source order. The similar commits
+# left out are the fewest that moved, and get the moved status. Rows between
+# aligned lines are paired like in pair_rows.
+def align_rows(source_diff_list, destination_diff_list, keys=None):
+    matched = (Status.common, Status.similar)
+    # Positions of each key on the destination side, last one on top
+    positions = {}
+    for j in reversed(range(len(destination_diff_list))):
+        row = destination_diff_list[j]
+        if row.status in matched:
+            _key = match_key([row.hash, row.title], keys)
+            positions.setdefault(_key, []).append(j)
+    matches = []
+    for i, row in enumerate(source_diff_list):
+        if row.status in matched:
+            candidates = positions.get(match_key([row.hash, row.title], keys))
+            if candidates:
+                matches.append((i, candidates.pop()))
+    with profile_stage('align'):
+        aligned = [
+            matches[k]
+            for k in longest_increasing_subsequence([j for _, j in matches])
+        ]
+    profile_commits('align', len(matches))
+    sides = (list(source_diff_list), list(destination_diff_list))
+    for match in set(matches).difference(aligned):
+        for rows, position in zip(sides, match):
+            if rows[position].status == Status.similar:
+                rows[position] = rows[position]._replace(status=Status.moved)
+    source, destination = sides
+    previous_i = previous_j = 0
+    aligned.append((len(source), len(destination)))
+    for i, j in aligned:
+        yield from pair_rows(source[previous_i:i], destination[previous_j:j])
+        if i < len(source):
+            yield source[i], destination[j]
+        previous_i, previous_j = i + 1, j + 1
+
+
+# Format side by side pairs into lines of text, one at a time
+def format_side_by_side(side_by_side, line_length):
+    width = column_width(line_length)
+    with profile_stage('render'):
+        for pair in side_by_side:
+            texts = []
+            for row in pair:
+                if row is None:
+                    texts.append(format_lint([''], width))
+                else:
+                    line = [
+                        row_text(row, hash_length),
+                        status_colors[row.status],
+                    ]
+                    texts.append(format_lint(line, width))
+            yield texts[0] + '  ' + texts[1]
+
+
+# The src-only rows on top of all the dest rows
+def recut_rows(source_diff_list, destination_diff_list):
     res = []
-    # Compute the existing commits and title elements
-    source_title_map = create_title_map(commits_source, _hash)
-    destination_title_map = create_title_map(commits_destination, _hash)
     # Take all of the src-only commits and cut them on top of dest's stem
-    source_diff_list = construct_diff_list(
-        commits_source, source_title_map, destination_title_map, _hash
-    )
-    for line in source_diff_list:
-        if line[1] == BColors.SRC_NEW:
-            res.append(line)
+    for row in source_diff_list:
+        if row.status == Status.src_new:
+            res.append(row)
     # Use the destination branch as the stem (unchanged)
-    destination_diff_list = construct_diff_list(
-        commits_destination, source_title_map, destination_title_map, _hash
-    )
-    for line in destination_diff_list:
-        res.append(line)
+    for row in destination_diff_list:
+        res.append(row)
     return res
 
 
-# Print lines in reverse order so they are copy-paste ready for interactive rebase
-def print_for_rebase(lines):
-    lines = lines[:]
-    lines.reverse()
-    lines = [['pick ' + line[0], line[1]] for line in lines]
-    widest = len(max(lines, key=lambda line: len(line[0]))[0])
+# Print rows in reverse order so they are copy-paste ready for interactive rebase
+def print_for_rebase(rows, destination, line_length, predictions=None):
+    with profile_stage('render'):
+        print_rebase_lines(rows, destination, line_length, predictions)
+
+
+# Notes on picks whose outcome was predicted (see predict_conflicts)
+prediction_notes = {
+    Prediction.clean: (' # Applies cleanly', BColors.COMMON),
+    Prediction.conflict: (' # Conflicts in ', BColors.DEST_NEW),
+    Prediction.unknown: (' # After a conflict', BColors.SIMILAR),
+}
+
+
+def print_rebase_lines(rows, destination, line_length, predictions=None):
+    # Size the column first, so that lines can be printed as they're built
+    widest = max(len(row_text(row, recut_hash_length)) for row in rows)
+    widest += len('pick ')
     prefix = ' # Only on '
     extras_length = len(prefix) + branch_name_length
     if widest < line_length - extras_length:
         width = widest
     else:
         width = line_length - extras_length
-    for line in lines:
+    for row in reversed(rows):
+        line = [
+            'pick ' + row_text(row, recut_hash_length),
+            status_colors[row.status],
+        ]
         extras = ''
         if line[1] == BColors.DEST_NEW:
             extras = colorize(
                 prefix
-                + '{}'.format(fix_text_length(dest, width=branch_name_length)),
+                + '{}'.format(
+                    fix_text_length(destination, width=branch_name_length)
+                ),
                 BColors.WHITE,
             )
+        elif predictions is not None and row.hash in predictions:
+            prediction, paths = predictions[row.hash]
+            note, color = prediction_notes[prediction]
+            extras = colorize(note + ', '.join(paths), color)
         print(format_lint(line, width=width) + extras)
 
 
 # Show relevant history side by side
-def show_side_by_side():
-    global hash_length, line_length
-    hash_length = 7
-    source_branch = fix_text_length(src + ' (src)')
-    destination_branch = fix_text_length(dest + ' (dest)')
+def show_side_by_side(comparison, line_length):
+    width = column_width(line_length)
+    source_branch = fix_text_length(comparison.src + ' (src)', width)
+    destination_branch = fix_text_length(comparison.dest + ' (dest)', width)
     print(
-        format_lint([source_branch, BColors.BOLD])
+        format_lint([source_branch, BColors.BOLD], width)
         + '  '
-        + format_lint([destination_branch, BColors.BOLD])
+        + format_lint([destination_branch, BColors.BOLD], width)
     )
     print(
-        format_lint([re.sub(r'.', '-', source_branch), BColors.BOLD])
+        format_lint([re.sub(r'.', '-', source_branch), BColors.BOLD], width)
         + '  '
-        + format_lint([re.sub(r'.', '-', destination_branch), BColors.BOLD])
-    )
-    common_hash = find_first_common_hash(source_history, destination_history, 4)
-    lines = compute_side_by_side(
-        source_history, destination_history, common_hash
+        + format_lint(
+            [re.sub(r'.', '-', destination_branch), BColors.BOLD], width
+        )
     )
-    for line in lines:
+    pairs = comparison.iter_side_by_side()
+    for line in format_side_by_side(pairs, line_length):
         print(line)
 
 
-# Show recut proposal
-def show_recut_offer():
-    global hash_length, line_length
-    hash_length = 16
-    title_text = 'Recut {} from {}'.format(src, dest)
-    title = fix_text_length(title_text)
-    _title = format_lint([title, BColors.BOLD])
+# Show recut proposal, with the predicted outcome of each pick if asked
+def show_recut_offer(comparison, line_length, predict=False):
+    width = column_width(line_length)
+    title_text = 'Recut {} from {}'.format(comparison.src, comparison.dest)
+    title = fix_text_length(title_text, width)
+    _title = format_lint([title, BColors.BOLD], width)
     print(_title)
-    print((format_lint([re.sub(r'.', '-', title), BColors.BOLD])))
-    common_hash = find_first_common_hash(source_history, destination_history, 4)
-    lines = compute_recut_offer(
-        source_history, destination_history, common_hash
+    print((format_lint([re.sub(r'.', '-', title), BColors.BOLD], width)))
+    predictions = comparison.predict_conflicts() if predict else None
+    print_for_rebase(
+        comparison.recut(), comparison.dest, line_length, predictions
+    )
+
+
+# Machine-readable records of the side by side view: one per row, with the
+# index of the line it is aligned on
+def side_by_side_records(side_by_side):
+    for index, pair in enumerate(side_by_side):
+        for side, row in zip(['src', 'dest'], pair):
+            if row is not None:
+                yield row_record(row, side, index)
+
+
+# Machine-readable records of the recut view, in interactive rebase order.
+# Picks whose outcome was predicted (see predict_conflicts) say so.
+def recut_records(rows, predictions=None):
+    for index, row in enumerate(reversed(rows)):
+        side = 'src' if row.status == Status.src_new else 'dest'
+        record = row_record(row, side, index)
+        if predictions is not None and row.hash in predictions:
+            record['prediction'], record['conflicts'] = predictions[row.hash]
+        yield record
+
+
+def row_record(row, side, index):
+    record = {
+        'index': index,
+        'side': side,
+        'hash': row.hash,
+        'title': row.title,
+        'status': row.status,
+        'duplicate': row.duplicate,
+    }
+    if row.similarity is not None:
+        record['similarity'] = row.similarity
+    if row.contained_in is not None:
+        record['contained_in'] = list(row.contained_in)
+    if row.rewrite is not None:
+        record['rewrite'] = row.rewrite
+        record['pair'] = row.pair
+    return record
+
+
+# Print records as they are produced, as a JSON array or one per line
+def print_records(records, _format):
+    with profile_stage('render'):
+        if _format == Format.ndjson:
+            for record in records:
+                print(json.dumps(record))
+            return
+        print('[')
+        separator = ''
+        for record in records:
+            print(separator + json.dumps(record), end='')
+            separator = ',\n'
+        print('\n]' if separator else ']')
+
+
+# Print one summary line per branch compared with the base
+def show_matrix(base, summaries, line_length):
+    width = max([len(summary.branch) for summary in summaries] + [6])
+    header = '{:<{}}  {:>6}  {:>6}  {:>7}'.format(
+        'Branch', width, 'Ahead', 'Behind', 'Similar'
+    )
+    print(colorize('Compared with {}'.format(base), BColors.BOLD))
+    print(colorize(header[:line_length], BColors.BOLD))
+    for summary in summaries:
+        line = '{:<{}}  {:>6}  {:>6}  {:>7}'.format(
+            summary.branch,
+            width,
+            summary.ahead,
+            summary.behind,
+            summary.similar,
+        )
+        print(line[:line_length])
+
+
+# Grab inline history of a branch (a cached hash when the repository's
+# cache is enabled)
+def read_history(branch, repository=None):
+    with profile_stage('load'):
+        walk = repository.walk(branch) if repository is not None else None
+        if walk is not None:
+            history = History(commit for commit, _ in walk)
+            profile_commits('load', len(history))
+            return history
+        history = run(
+            ['git', '--no-pager', 'log', branch, '--pretty=oneline'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.splitlines()
+    profile_commits('load', len(history))
+    with profile_stage('parse'):
+        history = process_history(history)
+    profile_commits('parse', len(history))
+    return history
+
+
+# The commits of `tip` that are not in the history of `base`, in `git log`
+# order, when `tip` only fast-forwarded from `base` so that its history is
+# these commits followed by the history of `base`: the new commits have no
+# parent outside of them but `base` (the only boundary commit), and are
+# listed first, either because they are a single line of commits or because
+# they are all newer than `base`. Returns None otherwise, e.g. when the
+# history was rewritten or another branch was merged in.
+def read_fast_forward(base, tip):
+    with profile_stage('load'):
+        lines = run(
+            [
+                'git',
+                '--no-pager',
+                'log',
+                '--boundary',
+                '--pretty=format:%m%ct %H %P%x09%s',
+                tip,
+                '^' + base,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.splitlines()
+    profile_commits('load', len(lines))
+    commits = []
+    dates = []
+    linear = True
+    boundary = []
+    for line in lines:
+        head, _, _title = line.partition('\t')
+        fields = head[1:].split()
+        if head[0] == '-':
+            boundary.append(fields[1])
+            base_date = int(fields[0])
+        else:
+            commits.append([fields[1], _title])
+            dates.append(int(fields[0]))
+            linear = linear and len(fields) == 3
+    if not commits or boundary != [base]:
+        return None
+    if not linear and min(dates) <= base_date:
+        return None
+    return commits
+
+
+# Parses `git log --pretty=format:%H %P%x09%s` lines to commits and parents
+def parse_log_lines(lines):
+    for line in lines:
+        head, _, _title = line.rstrip('\n').partition('\t')
+        hashes = head.split()
+        yield [hashes[0], _title], hashes[1:]
+
+
+# Reads (hash, title) commits from a live `git log` pipe (or from the commit
+# cache) as they are needed. Iterating yields new commits; everything read so
+# far is kept in `commits`.
+class HistoryStream:
+    def __init__(self, branch, repository=None):
+        self.commits = History()
+        self.parents = {}
+        self.exhausted = False
+        self.process = None
+        self.source = None
+        if repository is not None:
+            self.source = repository.walk(branch)
+        if self.source is None:
+            args = [
+                'git',
+                '--no-pager',
+                'log',
+                branch,
+                '--pretty=format:%H %P%x09%s',
+            ]
+            self.process = Popen(args, stdout=PIPE, universal_newlines=True)
+            self.source = parse_log_lines(
+                profile_output(args, self.process.stdout)
+            )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.read():
+            raise StopIteration
+        return self.commits[-1]
+
+    # Read one more commit, returns False at the end of history
+    def read(self):
+        if self.exhausted:
+            return False
+        entry = next(self.source, None)
+        if entry is None:
+            self.exhausted = True
+            return False
+        commit, parents = entry
+        self.parents[commit[0]] = parents
+        self.commits.append(commit[0], commit[1])
+        return True
+
+    # Read until `count` commits are loaded or the history runs out
+    def fill(self, count):
+        while len(self.commits) < count and self.read():
+            pass
+
+    # Read until the given hash is loaded, returns False if it never shows up
+    def find(self, _hash):
+        if _hash in self.parents:
+            return True
+        while self.read():
+            if self.commits[-1][0] == _hash:
+                return True
+        return False
+
+    # Position of a loaded hash in the history
+    def index(self, _hash):
+        return self.commits.index(_hash)
+
+    # Hashes of the loaded commits below `_hash` that are its ancestors
+    def ancestors(self, _hash, rows):
+        index = self.index(_hash)
+        reachable = set(self.parents[_hash])
+        res = []
+        for i in range(index + 1, min(index + 1 + rows, len(self.commits))):
+            commit = self.commits.hash(i)
+            if commit in reachable:
+                reachable.update(self.parents[commit])
+                res.append(commit)
+        return res
+
+    # Stop git, no more history is needed
+    def close(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+# Stream both histories and stop reading as soon as the view is complete:
+# the common hash, its trailing context, and (in the other history) every
+# trailing commit that is shared through the common hash. Startup time then
+# depends on the divergence of the branches rather than the repository age.
+# Note: commits older than the window are not considered for title matching.
+def read_bounded_histories(source, destination, repository=None):
+    with profile_stage('load'):
+        histories = read_bounded_streams(source, destination, repository)
+    profile_commits('load', len(histories[0]) + len(histories[1]))
+    return histories
+
+
+def read_bounded_streams(source, destination, repository=None):
+    source_stream = HistoryStream(source, repository)
+    destination_stream = HistoryStream(destination, repository)
+    try:
+        try:
+            _hash = find_first_common_hash(source_stream, destination_stream)
+        except Exception:  # pylint: disable=broad-except
+            return source_stream.commits, destination_stream.commits
+        streams = (source_stream, destination_stream)
+        # Read both sides to the same depth so titles can be matched
+        depth = 0
+        for stream in streams:
+            depth = max(depth, stream.index(_hash) + 1 + trailing_rows)
+        for stream in streams:
+            stream.fill(depth)
+        for stream, other in (streams, streams[::-1]):
+            for ancestor in stream.ancestors(_hash, trailing_rows):
+                other.find(ancestor)
+        return source_stream.commits, destination_stream.commits
+    finally:
+        source_stream.close()
+        destination_stream.close()
+
+
+# Hash the diffs of the given commits in one `git log -p | git patch-id` pipe
+def compute_patch_ids(hashes):
+    patch_ids = dict.fromkeys(hashes, '')
+    if not hashes:
+        return patch_ids
+    log = Popen(
+        [
+            'git',
+            '--no-pager',
+            'log',
+            '-p',
+            '--no-color',
+            '--no-ext-diff',
+            '--no-walk=unsorted',
+            '--stdin',
+        ],
+        stdin=PIPE,
+        stdout=PIPE,
+    )
+    args = ['git', 'patch-id', '--stable']
+    patch_id = Popen(
+        args, stdin=log.stdout, stdout=PIPE, universal_newlines=True
     )
-    print_for_rebase(lines)
+    log.stdout.close()
+    log.stdin.write(''.join(_hash + '\n' for _hash in hashes).encode())
+    log.stdin.close()
+    for line in profile_output(args, patch_id.stdout):
+        ids = line.split()
+        if len(ids) == 2:
+            patch_ids[ids[1]] = ids[0]
+    patch_id.stdout.close()
+    patch_id.wait()
+    log.wait()
+    return patch_ids
 
 
-def branch_exists(branch):
-    verify = run(
-        ['git', 'cat-file', '-t', branch],
+# Match keys for the commits unique to either branch: the stable patch-id
+# of their diff, so that cherry-picks match even when the title was edited.
+# Commits without a diff (e.g. merges) keep matching by hash only.
+# New patch-ids are added to the commit cache, to be saved by the caller.
+def read_patch_id_keys(source, destination, repository=None):
+    cache = repository.cache if repository is not None else None
+    divergent = run(
+        ['git', 'rev-list', source + '...' + destination],
         stdout=PIPE,
         universal_newlines=True,
         check=False,
-    ).stdout.strip()
-    return verify == 'commit'
+    ).stdout.split()
+    known = {}
+    if cache is not None:
+        for _hash in divergent:
+            patch_id = cache.patch_id(_hash)
+            if patch_id is not None:
+                known[_hash] = patch_id
+    missing = [_hash for _hash in divergent if _hash not in known]
+    with profile_stage('patch_ids'):
+        computed = compute_patch_ids(missing)
+    profile_commits('patch_ids', len(missing))
+    known.update(computed)
+    if cache is not None:
+        for _hash, patch_id in computed.items():
+            cache.set_patch_id(_hash, patch_id)
+    keys = {}
+    for _hash in divergent:
+        if known[_hash]:
+            keys[_hash] = known[_hash]
+    return keys
 
 
-# Basic command input parser
-def process_commands():
-    global src, dest, source_history, destination_history, line_length
+# Rows of both branches from one walk of their symmetric difference, which
+# git marks as only on the left (<), only on the right (>), or equivalent to
+# a commit on the other side (=). The newest boundary commit is the common
+# hash; like in the walk engine, each side shows its commits down to it plus
+# a few rows of context. Returns the source rows, destination rows and the
+# common hash.
+def read_cherry_mark_rows(source, destination):
+    # pylint: disable=too-many-locals
+    # The symmetric difference of a commit with itself is empty, both sides
+    # are the commit and its context
+    if source == destination:
+        rows = [
+            Row(_hash, _title, Status.common, False)
+            for _, _hash, _title in read_context(source)
+        ]
+        return rows, list(rows), source
+    with profile_stage('load'):
+        lines = run(
+            [
+                'git',
+                '--no-pager',
+                'log',
+                '--left-right',
+                '--cherry-mark',
+                '--boundary',
+                '--pretty=format:%m%ct %H %P%x09%s',
+                source + '...' + destination,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.splitlines()
+    profile_commits('load', len(lines))
+    commits = []
+    parents = {}
+    boundary = []
+    for line in lines:
+        head, _, _title = line.partition('\t')
+        fields = head[1:].split()
+        commit = (int(fields[0]), fields[1], _title, head[0])
+        parents[fields[1]] = fields[2:]
+        if head[0] == '-':
+            boundary.append(commit)
+        else:
+            commits.append(commit)
+    if not boundary:
+        raise Exception('The branches share no common history!')
+    # Boundary commits come last, the newest one is the common hash
+    common = max(boundary, key=lambda commit: commit[0])
+    # Equivalent commits aren't marked with their side, find the source side
+    # by walking down from the source tip to the boundary
+    left = set(commit[1] for commit in boundary)
+    pending = [source]
+    while pending:
+        _hash = pending.pop()
+        if _hash in left or _hash not in parents:
+            continue
+        left.add(_hash)
+        pending.extend(parents[_hash])
+    context = [
+        (date, _hash, _title, '-')
+        for date, _hash, _title in read_context(common[1])
+    ]
+    sides = ([], [])
+    for commit in commits:
+        sides[commit[1] not in left].append(commit)
+    rows = []
+    for side, status in zip(sides, [Status.src_new, Status.dest_new]):
+        # Commits older than the common hash only show up as context
+        newer = [commit for commit in side if commit[0] >= common[0]]
+        older = [commit for commit in side if commit[0] < common[0]]
+        trailing = sorted(
+            older + context[1:], key=lambda commit: -commit[0]
+        )[:trailing_rows]
+        statuses = {'=': Status.similar, '-': Status.common}
+        rows.append(
+            [
+                Row(_hash, _title, statuses.get(mark, status), False)
+                for _, _hash, _title, mark in newer + [common] + trailing
+            ]
+        )
+    return rows[0], rows[1], common[1]
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        'src', nargs='?', default='HEAD', help='Left side branch'
-    )
-    parser.add_argument('dest', help='Right side branch')
-    parser.add_argument(
-        '--key', help='Display with color code', action='store_true'
-    )
-    parser.add_argument('--recut', help='Recut view', action='store_true')
-    parser.add_argument('--cols', help='Number of columns')
-    args = parser.parse_args()
 
-    src = args.src
-    dest = args.dest
+# Date, hash and title of a commit and the few commits below it
+def read_context(_hash):
+    lines = run(
+        [
+            'git',
+            '--no-pager',
+            'log',
+            '--max-count={}'.format(trailing_rows + 1),
+            '--pretty=format:%ct %H%x09%s',
+            _hash,
+        ],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.splitlines()
+    context = []
+    for line in lines:
+        head, _, _title = line.partition('\t')
+        date, commit = head.split()
+        context.append((int(date), commit, _title))
+    return context
 
-    if not branch_exists(src):
-        print('Branch {} does not exist'.format(colorize(src, BColors.SRC_NEW)))
 
-    if not branch_exists(dest):
-        print(
-            'Branch {} does not exist'.format(colorize(dest, BColors.DEST_NEW))
+# [hash, title] commits listed by `git log` with extra arguments
+def read_log(args):
+    lines = run(
+        ['git', '--no-pager', 'log', '--pretty=format:%H%x09%s'] + args,
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.splitlines()
+    profile_commits('load', len(lines))
+    return History(line.split('\t', 1) for line in lines)
+
+
+# Histories of both branches as git walks them from their parents, down to
+# their merge-base instead of as far as the lockstep walk of
+# find_first_common_hash goes, followed by the merge-base and a few rows of
+# context. With `first_parent` only the first parent of merges is followed,
+# so each merged side branch is folded into the row of its merge commit.
+# With `topo_order` the commits of a side branch are listed together rather
+# than interleaved by date. Returns the source history, the destination
+# history and the merge-base.
+def read_dag_histories(
+    source, destination, repository=None, first_parent=False, topo_order=False
+):
+    with profile_stage('common_hash'):
+        if repository is not None and repository.objects is not None:
+            merge_base = repository.objects.merge_base(source, destination)
+        else:
+            merge_base = run(
+                ['git', 'merge-base', source, destination],
+                stdout=PIPE,
+                universal_newlines=True,
+                check=False,
+            ).stdout.strip()
+    if not merge_base:
+        raise Exception('The branches share no common history!')
+    options = []
+    if first_parent:
+        options.append('--first-parent')
+    if topo_order:
+        options.append('--topo-order')
+    with profile_stage('load'):
+        source_history, destination_history, context = run_concurrently(
+            lambda: read_log(options + [source, '^' + merge_base]),
+            lambda: read_log(options + [destination, '^' + merge_base]),
+            lambda: read_log(
+                options
+                + ['--max-count={}'.format(trailing_rows + 1), merge_base]
+            ),
         )
+    return source_history + context, destination_history + context, merge_base
 
-    # Check if src and dest exist
-    if not (branch_exists(src) and branch_exists(dest)):
-        print(
-            'Local may not be synced with remote, please run {} and try again'.format(
-                colorize('git fetch', BColors.COMMON)
+
+######################
+### FUZZY MATCHING ###
+######################
+
+# Tags, ticket ids and pull request numbers that are added to the titles of
+# cherry-picks and backports, e.g. `[backport]`, `(cherry picked from ...)`,
+# `ABC-123:` or `#123`
+fuzzy_noise = re.compile(
+    r'\[[^\]]*\]|\([^)]*\)|\b[A-Za-z][A-Za-z0-9]*-\d+\b:?|#\d+'
+)
+fuzzy_separators = re.compile(r'[^0-9a-z]+')
+# Length of the character n-grams titles are compared by
+fuzzy_ngram = 3
+# MinHash signatures are split in bands of rows: titles sharing all the rows
+# of a band are candidates, so that titles with a similarity around
+# (1 / bands) ** (1 / rows) or more are found. There is one row per bin of
+# the 32-bit n-gram hashes, binned by their top bits.
+fuzzy_bands = 8
+fuzzy_rows = 4
+fuzzy_bin_bits = 5
+fuzzy_threshold = 0.7
+
+
+# Title without the noise cherry-picks add, lowercase and with runs of
+# punctuation and whitespace collapsed
+def normalize_title(_title):
+    text = fuzzy_separators.sub(' ', fuzzy_noise.sub(' ', _title).lower())
+    text = text.strip()
+    return text if text else _title.lower()
+
+
+# The character n-grams of a normalized title
+def title_ngrams(text):
+    text = ' {} '.format(text)
+    count = max(len(text) - fuzzy_ngram + 1, 1)
+    return {text[i : i + fuzzy_ngram] for i in range(count)}
+
+
+# Keys of the bands of the one permutation MinHash signature of a set of
+# n-grams: n-gram hashes are split in bins by their top bits, and each row of
+# the signature is the lowest hash of a bin. Empty bins borrow the row of the
+# next bin that isn't, with the distance (rotation densification), so that
+# short titles can still be compared. Titles share most of their n-grams, so
+# the (bin, hash) of each n-gram is computed once and kept in `table`.
+def minhash_keys(ngrams, table):
+    pairs = list(map(table.get, ngrams))
+    if None in pairs:
+        shift = 32 - fuzzy_bin_bits
+        for ngram in ngrams.difference(table):
+            # Multiply by an odd constant to spread the checksum to the top
+            value = zlib.crc32(ngram.encode('utf-8')) * 0x9E3779B1 & 0xFFFFFFFF
+            table[ngram] = (value >> shift, value)
+        pairs = list(map(table.get, ngrams))
+    # Later pairs overwrite earlier ones, keep the lowest hash of each bin
+    lowest = dict(sorted(pairs, reverse=True))
+    size = fuzzy_bands * fuzzy_rows
+    signature = list(map(lowest.get, range(size)))
+    if len(lowest) < size:
+        bins = sorted(lowest)
+        for i, value in enumerate(signature):
+            if value is None:
+                k = bisect.bisect(bins, i)
+                j = bins[k] if k < len(bins) else bins[0] + size
+                signature[i] = (lowest[j % size], j - i)
+    return [
+        hash((band, *signature[band * fuzzy_rows : (band + 1) * fuzzy_rows]))
+        for band in range(fuzzy_bands)
+    ]
+
+
+# Pairs of source and destination titles that are at least `threshold`
+# similar (Jaccard similarity of their n-grams), each title paired at most
+# once, best pairs first. Source titles are indexed by the keys of their
+# MinHash bands, and each destination title is only scored against the
+# source titles sharing a band with it, so that candidates are found in
+# near-linear time. Returns (source index, destination index, similarity).
+def match_fuzzy_titles(source_titles, destination_titles, threshold):
+    # pylint: disable=too-many-locals
+    # Titles that normalize the same way are indexed and scored once
+    sides = []
+    for titles in (source_titles, destination_titles):
+        positions = {}
+        for i, _title in enumerate(titles):
+            positions.setdefault(normalize_title(_title), []).append(i)
+        sides.append(positions)
+    table = {}
+    index = {}
+    source_ngrams = {}
+    for text in sides[0]:
+        source_ngrams[text] = ngrams = title_ngrams(text)
+        for key in minhash_keys(ngrams, table):
+            index.setdefault(key, []).append(text)
+    scored = []
+    candidate_count = 0
+    for destination_text in sides[1]:
+        ngrams = title_ngrams(destination_text)
+        candidates = set()
+        for key in minhash_keys(ngrams, table):
+            candidates.update(index.get(key, ()))
+        candidate_count += len(candidates)
+        for source_text in candidates:
+            common = len(source_ngrams[source_text] & ngrams)
+            score = common / (
+                len(source_ngrams[source_text]) + len(ngrams) - common
             )
+            if score >= threshold:
+                scored.append((score, source_text, destination_text))
+    matches = []
+    for score, source_text, destination_text in sorted(
+        scored, key=lambda item: -item[0]
+    ):
+        source_positions = sides[0][source_text]
+        destination_positions = sides[1][destination_text]
+        while source_positions and destination_positions:
+            matches.append(
+                (source_positions.pop(0), destination_positions.pop(0), score)
+            )
+    profile_commits('fuzzy', candidate_count)
+    return matches
+
+
+# Mark commits that are only on one side, but whose title is close enough to
+# that of a commit only on the other side, as similar, with their similarity
+def match_fuzzy_rows(source_rows, destination_rows, threshold):
+    rows = (list(source_rows), list(destination_rows))
+    unmatched = []
+    for side, status in zip(rows, [Status.src_new, Status.dest_new]):
+        unmatched.append(
+            [i for i, row in enumerate(side) if row.status == status]
         )
-        print('')
-        return
+    with profile_stage('fuzzy'):
+        matches = match_fuzzy_titles(
+            [rows[0][i].title for i in unmatched[0]],
+            [rows[1][j].title for j in unmatched[1]],
+            threshold,
+        )
+    for i, j, score in matches:
+        for side, position in zip(rows, [unmatched[0][i], unmatched[1][j]]):
+            side[position] = side[position]._replace(
+                status=Status.similar, similarity=score
+            )
+    return rows[0], rows[1]
+
 
-    # Grab inline history of both branches
-    source_history = run(
-        ['git', '--no-pager', 'log', src, '--pretty=oneline'],
+#######################
+### CONTAINING REFS ###
+#######################
+
+ref_kinds = ['heads', 'remotes', 'tags']
+
+
+# `git for-each-ref` patterns of a `--contained-in` pattern. Patterns without
+# a `refs/` prefix match branches, remote branches and tags, e.g. `release/*`.
+def ref_patterns(pattern):
+    if pattern.startswith('refs/'):
+        return [pattern]
+    return ['refs/{}/{}'.format(kind, pattern) for kind in ref_kinds]
+
+
+# Refs matching a `--contained-in` pattern, as (name, commit hash) pairs. Tags
+# are peeled to the commit they point to.
+def read_matching_refs(pattern):
+    lines = run(
+        [
+            'git',
+            'for-each-ref',
+            '--format=%(objecttype) %(objectname) %(*objecttype) '
+            '%(*objectname) %(refname:short)',
+        ]
+        + ref_patterns(pattern),
         stdout=PIPE,
         universal_newlines=True,
         check=False,
     ).stdout.splitlines()
-    destination_history = run(
-        ['git', '--no-pager', 'log', dest, '--pretty=oneline'],
+    refs = []
+    for line in lines:
+        fields = line.split(' ', 4)
+        if fields[0] == 'commit':
+            refs.append((fields[4], fields[1]))
+        elif fields[2] == 'commit':
+            refs.append((fields[4], fields[3]))
+    return refs
+
+
+# Names of the refs matching `pattern` that contain each of `hashes`, from a
+# single walk. Each ref is a bit of an integer bitset; the refs are walked in
+# topological order, children before parents, each commit passing on the
+# bits of the refs reaching it to its parents. The walk stops at the parents
+# of the `oldest` commits to annotate (the bottom rows of each side): the
+# others are all above those. Parents of other rows, like the merged branches
+# folded by --first-parent, may have older rows below them and stay in the
+# walk. `tips` (the compared branches) are walked too so that every commit to
+# annotate is reached.
+def read_containing_refs(pattern, hashes, tips, oldest):
+    # pylint: disable=too-many-locals
+    refs = read_matching_refs(pattern)
+    wanted = set(hashes)
+    if not refs or not wanted:
+        return {_hash: () for _hash in wanted}
+    parents = run(
+        ['git', 'rev-list', '--no-walk=unsorted', '--parents', '--stdin'],
+        input=''.join(_hash + '\n' for _hash in set(oldest)),
         stdout=PIPE,
         universal_newlines=True,
         check=False,
-    ).stdout.splitlines()
-    source_history = process_history(source_history)
-    destination_history = process_history(destination_history)
+    ).stdout.split()
+    boundary = set(parents).difference(wanted)
+    pending = {}
+    for bit, (_, _hash) in enumerate(refs):
+        pending[_hash] = pending.get(_hash, 0) | 1 << bit
+    starts = list(pending) + list(tips) + ['^' + _hash for _hash in boundary]
+    with profile_stage('contained_in'):
+        lines = run(
+            ['git', 'rev-list', '--topo-order', '--parents', '--stdin'],
+            input=''.join(start + '\n' for start in starts),
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.splitlines()
+        found = {}
+        for line in lines:
+            _hash, *commit_parents = line.split()
+            bits = pending.pop(_hash, 0)
+            if _hash in wanted:
+                found[_hash] = bits
+                if len(found) == len(wanted):
+                    break
+            if bits:
+                for parent in commit_parents:
+                    pending[parent] = pending.get(parent, 0) | bits
+        profile_commits('contained_in', len(lines))
+    names = [name for name, _ in refs]
+    contained = {
+        _hash: tuple(
+            name for bit, name in enumerate(names) if bits >> bit & 1
+        )
+        for _hash, bits in found.items()
+    }
+    # Rows below a parent the walk stopped at (only with out of order commit
+    # dates) are asked about one by one
+    for _hash in wanted.difference(found):
+        contained[_hash] = tuple(
+            run(
+                ['git', 'for-each-ref', '--format=%(refname:short)']
+                + ['--contains', _hash]
+                + ref_patterns(pattern),
+                stdout=PIPE,
+                universal_newlines=True,
+                check=False,
+            ).stdout.split()
+        )
+    return contained
 
-    print('')
-    cmd = Commands.show_side_by_side
-    # Display with color code
-    if args.key:
-        print_color_key(src, dest)
-    # Display with color code
-    if args.recut:
-        cmd = Commands.offset_recut
-    # Configure the number of columns
-    if args.cols != None:
-        line_length = int(args.cols)
-    else:
-        line_length = int(os.get_terminal_size().columns)
-    # Run the proper command
-    if cmd == Commands.show_side_by_side:
-        show_side_by_side()
-    elif cmd == Commands.offset_recut:
-        show_recut_offer()
-    print('')
+
+# Annotate rows with the refs matching `pattern` that contain them (see
+# read_containing_refs)
+def annotate_containing_refs(source_rows, destination_rows, pattern, tips):
+    rows = (source_rows, destination_rows)
+    contained = read_containing_refs(
+        pattern,
+        [row.hash for side in rows for row in side],
+        tips,
+        [side[-1].hash for side in rows if side],
+    )
+    return tuple(
+        [row._replace(contained_in=contained[row.hash]) for row in side]
+        for side in rows
+    )
+
+
+################
+### REWRITES ###
+################
+
+# Old and new commits are paired when the average of the distance of their
+# titles and of their diff-size signatures is below this
+rewrite_cost_limit = 0.5
+# Paths changed by more old commits than this, like a changelog, don't make
+# commits changing them candidate pairs
+rewrite_path_commits = 8
+
+
+# Commits of a rewritten branch and of its previous version (`git log
+# --left-right old...new`), as lists of (hash, title, {path: changed lines}).
+# Merges are sized by their diff against their first parent.
+def read_rewritten_commits(old, new):
+    with profile_stage('load'):
+        output = run(
+            [
+                'git',
+                '--no-pager',
+                'log',
+                '--left-right',
+                '--numstat',
+                '--no-renames',
+                '-m',
+                '--pretty=format:%x00%m%H%x09%s',
+                old + '...' + new,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+    sides = ([], [])
+    seen = set()
+    for record in output.split('\0')[1:]:
+        head, *lines = record.splitlines()
+        _hash, _, _title = head[1:].partition('\t')
+        # -m repeats merges once per parent, the first parent comes first
+        if _hash in seen:
+            continue
+        seen.add(_hash)
+        sizes = {}
+        for line in lines:
+            fields = line.split('\t', 2)
+            if len(fields) == 3:
+                # Binary files have no line counts
+                added, deleted, path = fields
+                sizes[path] = int(added) + int(deleted) if added != '-' else 1
+        sides[head[0] == '>'].append((_hash, _title, sizes))
+    profile_commits('load', len(sides[0]) + len(sides[1]))
+    return sides
+
+
+# Distance between the diff-size signatures of two commits: one minus the
+# weighted Jaccard similarity of the lines they change in each path. A path
+# weighs at least 1 even when no line changed (empty files, mode changes),
+# and commits changing no common path are as far apart as can be.
+def diff_size_distance(sizes, other_sizes):
+    if not sizes and not other_sizes:
+        return 0.0
+    if sizes.keys().isdisjoint(other_sizes):
+        return 1.0
+    lowest = highest = 0
+    for path in set(sizes).union(other_sizes):
+        size = max(1, sizes[path]) if path in sizes else 0
+        other_size = max(1, other_sizes[path]) if path in other_sizes else 0
+        lowest += min(size, other_size)
+        highest += max(size, other_size)
+    return 1.0 - lowest / highest
+
+
+# Pairs of old and new commits that may be versions of each other: commits
+# with the same patch-id, sharing a band of the MinHash signature of their
+# titles (see minhash_keys) or changing a path few other commits change
+# (see rewrite_path_commits). Returns {(old index, new index): cost}, the
+# cost being the average of their title distance and diff-size distance, or
+# 0 for the diff when the patch-ids are the same.
+def rewrite_candidates(old_commits, new_commits, patch_ids):
+    # pylint: disable=too-many-locals
+    table = {}
+
+    def candidate_keys(commit, ngrams):
+        keys = minhash_keys(ngrams, table)
+        if commit[0] in patch_ids:
+            keys.append(('patch-id', patch_ids[commit[0]]))
+        return keys
+
+    index = {}
+    path_index = {}
+    old_ngrams = []
+    for i, commit in enumerate(old_commits):
+        old_ngrams.append(title_ngrams(normalize_title(commit[1])))
+        for key in candidate_keys(commit, old_ngrams[i]):
+            index.setdefault(key, set()).add(i)
+        for path in commit[2]:
+            path_index.setdefault(path, set()).add(i)
+    costs = {}
+    for j, commit in enumerate(new_commits):
+        ngrams = title_ngrams(normalize_title(commit[1]))
+        candidates = set()
+        for key in candidate_keys(commit, ngrams):
+            candidates.update(index.get(key, ()))
+        for path in commit[2]:
+            matches = path_index.get(path, ())
+            if len(matches) <= rewrite_path_commits:
+                candidates.update(matches)
+        patch_id = patch_ids.get(commit[0])
+        for i in candidates:
+            old_hash, _, old_sizes = old_commits[i]
+            common = len(old_ngrams[i] & ngrams)
+            title_distance = 1.0 - common / (
+                len(old_ngrams[i]) + len(ngrams) - common
+            )
+            # Too far apart even if the diffs were the same
+            if title_distance >= 2 * rewrite_cost_limit:
+                continue
+            if patch_id is not None and patch_ids.get(old_hash) == patch_id:
+                diff_distance = 0.0
+            else:
+                diff_distance = diff_size_distance(old_sizes, commit[2])
+            cost = (title_distance + diff_distance) / 2
+            if cost < rewrite_cost_limit:
+                costs[(i, j)] = cost
+    return costs
+
+
+# Minimum cost assignment of the rows of a cost matrix to distinct columns,
+# with no more rows than columns (Hungarian algorithm with potentials, one
+# shortest augmenting path per row, O(rows² columns)). Returns the column of
+# each row.
+def solve_assignment(costs):
+    # pylint: disable=too-many-locals
+    count = len(costs[0])
+    infinity = float('inf')
+    row_potentials = [0.0] * (len(costs) + 1)
+    column_potentials = [0.0] * (count + 1)
+    # Row (from 1) assigned to each column (from 1), column 0 is a sentinel
+    assigned = [0] * (count + 1)
+    previous = [0] * (count + 1)
+    for row in range(1, len(costs) + 1):
+        assigned[0] = row
+        column = 0
+        distances = [infinity] * (count + 1)
+        visited = [False] * (count + 1)
+        while assigned[column]:
+            visited[column] = True
+            current = assigned[column]
+            line = costs[current - 1]
+            delta = infinity
+            closest = 0
+            for j in range(1, count + 1):
+                if visited[j]:
+                    continue
+                reduced = (
+                    line[j - 1] - row_potentials[current] - column_potentials[j]
+                )
+                if reduced < distances[j]:
+                    distances[j] = reduced
+                    previous[j] = column
+                if distances[j] < delta:
+                    delta = distances[j]
+                    closest = j
+            for j in range(count + 1):
+                if visited[j]:
+                    row_potentials[assigned[j]] += delta
+                    column_potentials[j] -= delta
+                else:
+                    distances[j] -= delta
+            column = closest
+        # Flip the assignments along the augmenting path
+        while column:
+            assigned[column] = assigned[previous[column]]
+            column = previous[column]
+    columns = [None] * len(costs)
+    for column in range(1, count + 1):
+        if assigned[column]:
+            columns[assigned[column] - 1] = column - 1
+    return columns
+
+
+# Pair old and new versions of rewritten commits at the lowest total cost
+# (see rewrite_candidates), where leaving a commit out costs as much as the
+# most distant pair allowed. Candidate pairs form independent groups, which
+# are assigned one at a time so that the cost matrices stay small. Returns
+# {old index: new index}.
+def pair_rewrites(old_commits, new_commits, patch_ids):
+    # pylint: disable=too-many-locals
+    costs = rewrite_candidates(old_commits, new_commits, patch_ids)
+    # New commits are numbered after the old ones in the union-find forest
+    group = list(range(len(old_commits) + len(new_commits)))
+
+    def find(i):
+        while group[i] != i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+
+    for i, j in costs:
+        group[find(i)] = find(len(old_commits) + j)
+    groups = {}
+    for i, j in costs:
+        old, new = groups.setdefault(find(i), (set(), set()))
+        old.add(i)
+        new.add(j)
+    pairs = {}
+    for old, new in groups.values():
+        old, new = sorted(old), sorted(new)
+        transpose = len(old) > len(new)
+        if transpose:
+            old, new = new, old
+        matrix = []
+        for a in old:
+            line = []
+            for b in new:
+                key = (b, a) if transpose else (a, b)
+                line.append(costs.get(key, rewrite_cost_limit))
+            # Leaving the commit out, as if paired with a commit of its own
+            line += [rewrite_cost_limit] * len(old)
+            matrix.append(line)
+        with profile_stage('assignment'):
+            columns = solve_assignment(matrix)
+        for a, column in zip(old, columns):
+            if column < len(new):
+                key = (new[column], a) if transpose else (a, new[column])
+                if key in costs:
+                    pairs[key[0]] = key[1]
+    profile_commits('assignment', len(costs))
+    return pairs
+
+
+# Rows of a branch before (old) and after (new) it was rewritten, e.g. by a
+# rebase: the commits of either version down to their merge-base, each old
+# commit paired with its new version (see pair_rewrites) and labeled with how
+# it changed, followed by a few rows of context. Returns the old rows, new
+# rows, the merge-base and match keys linking both versions of a commit.
+def read_rewrite_rows(old, new, repository=None):
+    # pylint: disable=too-many-locals
+    old_commits, new_commits = read_rewritten_commits(old, new)
+    merge_base = run(
+        ['git', 'merge-base', old, new],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.strip()
+    if not merge_base:
+        raise Exception('The branches share no common history!')
+    patch_ids = read_patch_id_keys(old, new, repository)
+    if repository is not None and repository.cache is not None:
+        repository.cache.save()
+    pairs = pair_rewrites(old_commits, new_commits, patch_ids)
+    old_rows = [
+        Row(_hash, _title, Status.src_new, False, rewrite=Rewrite.dropped)
+        for _hash, _title, _ in old_commits
+    ]
+    new_rows = [
+        Row(_hash, _title, Status.dest_new, False, rewrite=Rewrite.added)
+        for _hash, _title, _ in new_commits
+    ]
+    keys = {}
+    for i, j in pairs.items():
+        old_row, new_row = old_rows[i], new_rows[j]
+        old_id = patch_ids.get(old_row.hash)
+        new_id = patch_ids.get(new_row.hash)
+        if old_id is not None and new_id is not None:
+            same_content = old_id == new_id
+        else:
+            # Merges and empty commits have no patch-id, compare diff sizes
+            same_content = (
+                diff_size_distance(old_commits[i][2], new_commits[j][2]) == 0
+            )
+        status = Status.similar
+        if not same_content:
+            rewrite = Rewrite.content_changed
+        elif old_row.title != new_row.title:
+            rewrite = Rewrite.reworded
+        else:
+            rewrite = Rewrite.unchanged
+            status = Status.common
+        for rows, k, row, pair in [
+            (old_rows, i, old_row, new_row),
+            (new_rows, j, new_row, old_row),
+        ]:
+            rows[k] = row._replace(
+                status=status, rewrite=rewrite, pair=pair.hash
+            )
+            keys[row.hash] = new_row.hash
+    context = [
+        Row(_hash, _title, Status.common, False)
+        for _, _hash, _title in read_context(merge_base)
+    ]
+    return old_rows + context, new_rows + context, merge_base, keys
+
+
+####################
+### COMMIT CACHE ###
+####################
+
+
+# The repository's (common) git directory, where objects and caches live
+def git_directory():
+    return run(
+        ['git', 'rev-parse', '--git-common-dir'],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.strip()
+
+
+# Binary search a table of fixed-size entries sorted by a leading 20-byte
+# hash, returns the index of the entry or None
+def search_sorted_hashes(table, key, low, high, size=20, start=0):
+    end = high
+    while low < high:
+        middle = (low + high) // 2
+        position = start + middle * size
+        if table[position : position + 20] < key:
+            low = middle + 1
+        else:
+            high = middle
+    position = start + low * size
+    if low < end and table[position : position + 20] == key:
+        return low
+    return None
+
+
+# Walk history in the same order as `git log`: newest commit date first, ties
+# broken by the order in which commits were discovered. `read` maps a key to
+# a (hash, date, [(parent, parent key)], title) record; parents whose key is
+# None are not available and are skipped. Yields (hash, title) commits along
+# with their parents.
+def walk_by_date(tip, read):
+    sequence = 0
+    record = read(tip)
+    seen = {tip}
+    queue = [(-record[1], sequence, record)]
+    while queue:
+        _, _, record = heapq.heappop(queue)
+        _hash, _, parents, _title = record[:4]
+        yield [_hash, _title], [parent for parent, _ in parents]
+        for _, key in parents:
+            if key is not None and key not in seen:
+                seen.add(key)
+                sequence += 1
+                record = read(key)
+                heapq.heappush(queue, (-record[1], sequence, record))
+
+
+# Commit metadata (parents, commit date, subject and optionally patch-id)
+# stored under .git/gomp-cache. Commits are immutable so entries never go
+# stale. `commits.dat` is an append-only log of variable-length records and
+# `commits.idx` is a sorted table of fixed-width (hash, offset) entries. Both
+# are memory-mapped: hashes are binary searched in the index, and records
+# store the offsets of their parents so history is walked without lookups.
+# The cache is closed under ancestry: every cached commit's parents are
+# cached too, so a cached tip never needs to be walked by git again.
+class CommitCache:
+    # pylint: disable=too-many-instance-attributes
+    entry = struct.Struct('>20sQ')
+    header = struct.Struct('>20sqBBI')
+    parent = struct.Struct('>20sQ')
+    missing = 2**64 - 1
+    # Patch-id states
+    unknown = 0
+    no_diff = 1
+    known = 2
+    max_tips = 64
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = {}
+        self.files = []
+        self.load()
+
+    def load(self):
+        self.tips = []
+        self.index = b''
+        self.data = b''
+        try:
+            with open(self.path('tips'), 'r') as f:
+                self.tips = f.read().split()
+            self.index = self.map('commits.idx')
+            self.data = self.map('commits.dat')
+        except OSError:
+            self.index = b''
+            self.data = b''
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def map(self, name):
+        f = open(self.path(name), 'rb')  # pylint: disable=consider-using-with
+        self.files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.index) // self.entry.size
+
+    def __contains__(self, _hash):
+        return self.get(_hash) is not None
+
+    # Binary search the memory-mapped index for a hash's record offset
+    def lookup(self, _hash):
+        key = bytes.fromhex(_hash)
+        size = self.entry.size
+        i = search_sorted_hashes(self.index, key, 0, len(self), size)
+        if i is None:
+            return None
+        _, offset = self.entry.unpack_from(self.index, i * size)
+        if offset + self.header.size > len(self.data):
+            return None
+        # Guard against records torn by an interrupted write
+        if self.data[offset : offset + 20] != key:
+            return None
+        return offset
+
+    # Returns (hash, date, [(parent, offset)], title, patch-id state, patch-id)
+    # Offsets of parents missing from the cache (shallow history) are None
+    def read(self, offset):
+        key, date, parent_count, state, title_length = (
+            self.header.unpack_from(self.data, offset)
+        )
+        position = offset + self.header.size
+        parents = []
+        for _ in range(parent_count):
+            parent, parent_offset = self.parent.unpack_from(self.data, position)
+            if parent_offset == self.missing:
+                parent_offset = None
+            parents.append((parent.hex(), parent_offset))
+            position += self.parent.size
+        patch_id = ''
+        if state == self.known:
+            patch_id = self.data[position : position + 20].hex()
+            position += 20
+        _title = self.data[position : position + title_length]
+        _title = _title.decode('utf-8', 'replace')
+        return key.hex(), date, parents, _title, state, patch_id
+
+    # Returns (date, parents, title, patch-id state, patch-id) or None
+    def get(self, _hash):
+        if _hash in self.pending:
+            return self.pending[_hash]
+        offset = self.lookup(_hash)
+        if offset is None:
+            return None
+        _, date, parents, _title, state, patch_id = self.read(offset)
+        parents = [parent for parent, _ in parents]
+        return date, parents, _title, state, patch_id
+
+    def add(self, _hash, date, parents, _title):
+        self.pending[_hash] = (date, parents, _title, self.unknown, '')
+
+    # Returns the cached patch-id ('' for commits without a diff) or None
+    def patch_id(self, _hash):
+        record = self.get(_hash)
+        if record is None or record[3] == self.unknown:
+            return None
+        return record[4]
+
+    def set_patch_id(self, _hash, patch_id):
+        record = self.get(_hash)
+        if record is None:
+            return
+        state = self.known if patch_id else self.no_diff
+        self.pending[_hash] = record[:3] + (state, patch_id)
+
+    def add_tip(self, _hash):
+        if _hash in self.tips:
+            self.tips.remove(_hash)
+        self.tips.insert(0, _hash)
+        del self.tips[self.max_tips :]
+
+    # Walk the history of a saved tip in `git log` order, returns None if the
+    # tip isn't cached after all
+    def walk(self, tip):
+        offset = self.lookup(tip)
+        if offset is None:
+            return None
+        return walk_by_date(offset, self.read)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+    # Append pending records and rewrite the index with their offsets.
+    # Returns False if the cache could not be written (e.g. read-only
+    # repository), in which case the caller should read history from git.
+    def save(self):
+        if not self.pending:
+            return True
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Other gomp processes may save at the same time: offsets and the
+            # index are computed from the files as they are once locked
+            with open(self.path('lock'), 'w') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                self.reload()
+                self.write()
+            self.pending = {}
+            return True
+        except OSError:
+            return False
+
+    # Map the files again to see what other processes saved, keeping the
+    # tips of both
+    def reload(self):
+        tips = self.tips
+        self.close()
+        self.load()
+        self.tips = tips + [tip for tip in self.tips if tip not in tips]
+        del self.tips[self.max_tips :]
+
+    def write(self):
+        pending = self.new_records()
+        with open(self.path('commits.dat'), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            offsets = {}
+            for _hash, record in pending.items():
+                offsets[_hash] = offset
+                offset += self.record_size(record)
+            chunks = []
+            for _hash, record in pending.items():
+                chunks.append(self.pack(_hash, record, offsets))
+            f.write(b''.join(chunks))
+        records = [
+            (bytes.fromhex(_hash), offset) for _hash, offset in offsets.items()
+        ]
+        updated = {key for key, _ in records}
+        size = self.entry.size
+        for i in range(len(self)):
+            key, offset = self.entry.unpack_from(self.index, i * size)
+            if key not in updated:
+                records.append((key, offset))
+        records.sort()
+        index = b''.join(self.entry.pack(*record) for record in records)
+        self.replace('commits.idx', index)
+        self.replace('tips', ''.join(tip + '\n' for tip in self.tips))
+        self.close()
+        self.index = self.map('commits.idx')
+        self.data = self.map('commits.dat')
+
+    # The pending records to append. Commits may already be saved, by another
+    # process or before their tip was dropped from the tips: appending them
+    # again would only leave dead copies in the append-only file. They are
+    # only appended again when they gain a patch-id.
+    def new_records(self):
+        records = {}
+        for _hash, record in self.pending.items():
+            offset = self.lookup(_hash)
+            if offset is not None:
+                state = self.read(offset)[4]
+                if record[3] in (self.unknown, state):
+                    continue
+            records[_hash] = record
+        return records
+
+    def record_size(self, record):
+        _, parents, _title, state, _ = record
+        size = self.header.size + len(parents) * self.parent.size
+        if state == self.known:
+            size += 20
+        return size + len(_title.encode('utf-8'))
+
+    def pack(self, _hash, record, offsets):
+        date, parents, _title, state, patch_id = record
+        _title = _title.encode('utf-8')
+        chunks = [
+            self.header.pack(
+                bytes.fromhex(_hash), date, len(parents), state, len(_title)
+            )
+        ]
+        for parent in parents:
+            offset = offsets.get(parent)
+            if offset is None:
+                offset = self.lookup(parent)
+            if offset is None:
+                offset = self.missing
+            chunks.append(self.parent.pack(bytes.fromhex(parent), offset))
+        if state == self.known:
+            chunks.append(bytes.fromhex(patch_id))
+        chunks.append(_title)
+        return b''.join(chunks)
+
+    # Atomically replace a cache file
+    def replace(self, name, content):
+        mode = 'wb' if isinstance(content, bytes) else 'w'
+        temporary = self.path(name + '.tmp')
+        with open(temporary, mode) as f:
+            f.write(content)
+        os.replace(temporary, self.path(name))
+
+
+############################
+### NATIVE OBJECT READER ###
+############################
+
+
+# Reads a git variable-length size: 7 bits per byte, least significant first
+def read_size(data, position):
+    size = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, position
+
+
+# Decompress the zlib stream starting at `position` of a (mapped) file, or
+# only as much of it as `done(content)` needs
+def inflate(data, position, done=None):
+    decompressor = zlib.decompressobj()
+    chunks = []
+    length = 4096
+    while not decompressor.eof:
+        if done is not None and chunks and done(b''.join(chunks)):
+            break
+        piece = data[position : position + length]
+        if not piece:
+            raise ValueError('Truncated object')
+        chunks.append(decompressor.decompress(piece))
+        position += length
+        length *= 2
+    return b''.join(chunks)
+
+
+# Rebuild an object from its delta base and a pack delta
+def apply_delta(base, delta):
+    _, position = read_size(delta, 0)
+    _, position = read_size(delta, position)
+    result = bytearray()
+    while position < len(delta):
+        opcode = delta[position]
+        position += 1
+        if opcode & 0x80:
+            offset = 0
+            length = 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    offset |= delta[position] << (8 * i)
+                    position += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    length |= delta[position] << (8 * i)
+                    position += 1
+            result += base[offset : offset + (length or 0x10000)]
+        elif opcode:
+            result += delta[position : position + opcode]
+            position += opcode
+        else:
+            raise ValueError('Invalid delta')
+    return bytes(result)
+
+
+# A memory-mapped packfile along with its version 2 index
+class PackFile:
+    header = struct.Struct('>4sI')
+    ofs_delta = 6
+    ref_delta = 7
+    max_bases = 256
+
+    def __init__(self, index_path, repository):
+        self.repository = repository
+        # Delta bases resolved recently, by offset: neighbouring commits
+        # often share most of their delta chain
+        self.bases = {}
+        with open(index_path, 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(index_path[: -len('.idx')] + '.pack', 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.header.unpack_from(self.index) != (b'\377tOc', 2):
+            raise ValueError('Unsupported pack index ' + index_path)
+        self.count = struct.unpack_from('>I', self.index, 8 + 255 * 4)[0]
+        self.names = 8 + 256 * 4
+        self.offsets = self.names + self.count * 24
+        self.large_offsets = self.offsets + self.count * 4
+
+    # Offset of an object in the pack, or None if it isn't in this pack
+    def offset(self, key):
+        low = 0
+        if key[0]:
+            low = struct.unpack_from('>I', self.index, 8 + (key[0] - 1) * 4)[0]
+        high = struct.unpack_from('>I', self.index, 8 + key[0] * 4)[0]
+        i = search_sorted_hashes(self.index, key, low, high, start=self.names)
+        if i is None:
+            return None
+        offset = struct.unpack_from('>I', self.index, self.offsets + i * 4)[0]
+        if offset & 0x80000000:
+            position = self.large_offsets + (offset & 0x7FFFFFFF) * 8
+            offset = struct.unpack_from('>Q', self.index, position)[0]
+        return offset
+
+    # Returns (type, content) of the object at the given offset. Objects
+    # stored whole can be inflated only as far as `done(content)` needs.
+    def read(self, offset, done=None):
+        byte = self.data[offset]
+        kind = (byte >> 4) & 7
+        position = offset + 1
+        while byte & 0x80:
+            byte = self.data[position]
+            position += 1
+        if kind == self.ofs_delta:
+            byte = self.data[position]
+            position += 1
+            distance = byte & 0x7F
+            while byte & 0x80:
+                byte = self.data[position]
+                position += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7F)
+            kind, base = self.read_base(offset - distance)
+            return kind, apply_delta(base, inflate(self.data, position))
+        if kind == self.ref_delta:
+            base_key = bytes(self.data[position : position + 20])
+            kind, base = self.repository.read_object(base_key)
+            return kind, apply_delta(base, inflate(self.data, position + 20))
+        return kind, inflate(self.data, position, done)
+
+    def read_base(self, offset):
+        if offset not in self.bases:
+            if len(self.bases) >= self.max_bases:
+                self.bases.clear()
+            self.bases[offset] = self.read(offset)
+        return self.bases[offset]
+
+
+# The commit-graph file (or chain of files): parents, commit dates and
+# generation numbers of commits, addressed by their position in the graph
+class CommitGraph:
+    header = struct.Struct('>4sBBBB')
+    chunk = struct.Struct('>4sQ')
+    commit_data = struct.Struct('>20sIIII')
+    no_parent = 0x70000000
+
+    def __init__(self, paths):
+        self.layers = []
+        self.count = 0
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            signature, version, hash_version, chunk_count, _ = (
+                self.header.unpack_from(data)
+            )
+            if signature != b'CGPH' or version != 1 or hash_version != 1:
+                raise ValueError('Unsupported commit-graph ' + path)
+            chunks = {}
+            for i in range(chunk_count):
+                name, offset = self.chunk.unpack_from(
+                    data, self.header.size + i * self.chunk.size
+                )
+                chunks[name] = offset
+            count = struct.unpack_from('>I', data, chunks[b'OIDF'] + 255 * 4)[0]
+            self.layers.append((data, chunks, self.count, count))
+            self.count += count
+
+    # Open the repository's commit-graph, returns None if there is none
+    @classmethod
+    def open(cls, objects):
+        chain = os.path.join(objects, 'info', 'commit-graphs')
+        if os.path.exists(os.path.join(chain, 'commit-graph-chain')):
+            with open(os.path.join(chain, 'commit-graph-chain'), 'r') as f:
+                names = f.read().split()
+            return cls(
+                [os.path.join(chain, 'graph-' + n + '.graph') for n in names]
+            )
+        path = os.path.join(objects, 'info', 'commit-graph')
+        if os.path.exists(path):
+            return cls([path])
+        return None
+
+    # Position of a commit in the graph, or None if it isn't in the graph
+    def position(self, key):
+        for data, chunks, base, count in self.layers:
+            fanout = chunks[b'OIDF']
+            low = 0
+            if key[0]:
+                low = struct.unpack_from('>I', data, fanout + (key[0] - 1) * 4)
+                low = low[0]
+            high = struct.unpack_from('>I', data, fanout + key[0] * 4)[0]
+            names = chunks[b'OIDL']
+            i = search_sorted_hashes(data, key, low, high, start=names)
+            if i is not None:
+                return base + i
+        return None
+
+    def layer(self, position):
+        for layer in self.layers:
+            if position < layer[2] + layer[3]:
+                return layer
+        raise ValueError('Invalid commit-graph position')
+
+    def name(self, position):
+        data, chunks, base, _ = self.layer(position)
+        name = chunks[b'OIDL'] + (position - base) * 20
+        return data[name : name + 20].hex()
+
+    # Returns (date, generation, [parent positions])
+    def commit(self, position):
+        data, chunks, base, _ = self.layer(position)
+        local = position - base
+        _, first, second, high, low = self.commit_data.unpack_from(
+            data, chunks[b'CDAT'] + local * self.commit_data.size
+        )
+        parents = []
+        if first != self.no_parent:
+            parents.append(first)
+        if second & 0x80000000:
+            edges = chunks[b'EDGE'] + (second & 0x7FFFFFFF) * 4
+            while True:
+                edge = struct.unpack_from('>I', data, edges)[0]
+                parents.append(edge & 0x7FFFFFFF)
+                edges += 4
+                if edge & 0x80000000:
+                    break
+        elif second != self.no_parent:
+            parents.append(second)
+        date = ((high & 3) << 32) | low
+        return date, high >> 2, parents
+
+
+# Where the subject of a commit object ends: the first blank line after the
+# headers and the blank lines that may start the message. None if the object
+# is cut short before that.
+def subject_end(content):
+    start = content.find(b'\n\n')
+    if start < 0:
+        return None
+    start += 2
+    while content[start : start + 1] == b'\n':
+        start += 1
+    end = content.find(b'\n\n', start)
+    return end if end >= 0 else None
+
+
+# The subject of a commit message, as shown by `git log --pretty=oneline`:
+# the first paragraph with its lines joined by spaces
+def commit_subject(message):
+    lines = []
+    for line in message.split('\n'):
+        line = line.rstrip()
+        if line:
+            lines.append(line)
+        elif lines:
+            break
+    return ' '.join(lines)
+
+
+# Reads commits straight from the object database (commit-graph, packfiles
+# and loose objects) so that history is walked without spawning git. Only
+# used when the repository has a commit-graph; commits written after the
+# graph are parsed from their objects.
+class NativeRepository:
+    commit_type = 1
+
+    def __init__(self, git_dir, graph):
+        objects = os.path.join(git_dir, 'objects')
+        self.graph = graph
+        # Graph positions of the parents of the commits read so far, which
+        # saves searching the graph for most commits of a walk
+        self.positions = {}
+        self.directories = [objects]
+        alternates = os.path.join(objects, 'info', 'alternates')
+        if os.path.exists(alternates):
+            with open(alternates, 'r') as f:
+                for line in f.read().splitlines():
+                    if line and not line.startswith('#'):
+                        self.directories.append(os.path.join(objects, line))
+        self.packs = []
+        for directory in self.directories:
+            for index in glob.glob(os.path.join(directory, 'pack', '*.idx')):
+                self.packs.append(PackFile(index, self))
+        self.shallow = set()
+        shallow = os.path.join(git_dir, 'shallow')
+        if os.path.exists(shallow):
+            with open(shallow, 'r') as f:
+                self.shallow = set(f.read().split())
+
+    # Returns a reader for the repository, or None to fall back to git
+    @classmethod
+    def open(cls, git_dir):
+        try:
+            graph = CommitGraph.open(os.path.join(git_dir, 'objects'))
+            if graph is None:
+                return None
+            return cls(git_dir, graph)
+        except (OSError, ValueError, KeyError, struct.error):
+            return None
+
+    # Returns (type, content) of an object, see PackFile.read for `done`
+    def read_object(self, key, done=None):
+        for pack in self.packs:
+            offset = pack.offset(key)
+            if offset is not None:
+                return pack.read(offset, done)
+        name = key.hex()
+        for directory in self.directories:
+            path = os.path.join(directory, name[:2], name[2:])
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    data = zlib.decompress(f.read())
+                header, _, content = data.partition(b'\0')
+                kind = header.split()[0]
+                return {b'commit': self.commit_type}.get(kind, 0), content
+        raise KeyError('Missing object ' + name)
+
+    # Returns (parents, date, title) parsed from a commit object, or only
+    # the title when `headers` is False. The object is read once, and only
+    # down to the end of the subject.
+    def parse_commit(self, _hash, headers=True):
+        kind, content = self.read_object(bytes.fromhex(_hash), subject_end)
+        if kind != self.commit_type:
+            raise ValueError('Not a commit ' + _hash)
+        start = content.find(b'\n\n')
+        if start < 0:
+            start = len(content)
+        end = subject_end(content)
+        message = content[start + 2 : end]
+        _title = commit_subject(message.decode('utf-8', 'replace'))
+        if not headers:
+            return None, None, _title
+        parents = []
+        date = 0
+        for header in content[:start].split(b'\n'):
+            if header.startswith(b'parent '):
+                parents.append(header[7:].decode())
+            elif header.startswith(b'committer '):
+                date = int(header.rsplit(b' ', 2)[1])
+        return parents, date, _title
+
+    # Position of a commit in the commit-graph, None if it isn't in the graph
+    # or is a shallow boundary (the graph still lists its parents)
+    def graph_position(self, _hash):
+        if _hash in self.shallow:
+            return None
+        position = self.positions.get(_hash)
+        if position is None:
+            position = self.graph.position(bytes.fromhex(_hash))
+        return position
+
+    # Returns (parents, date) of the commit at a position of the graph
+    def graph_parents_and_date(self, position):
+        date, _, positions = self.graph.commit(position)
+        parents = []
+        for parent in positions:
+            name = self.graph.name(parent)
+            self.positions[name] = parent
+            parents.append(name)
+        return parents, date
+
+    # Returns (parents, date) using the commit-graph when possible
+    def parents_and_date(self, _hash):
+        position = self.graph_position(_hash)
+        if position is not None:
+            return self.graph_parents_and_date(position)
+        parents, date, _ = self.parse_commit(_hash)
+        return ([] if _hash in self.shallow else parents), date
+
+    # Returns a walk record (hash, date, [(parent, parent)], title). Commits
+    # in the graph only have their object read for the title.
+    def read(self, _hash):
+        position = self.graph_position(_hash)
+        if position is None:
+            parents, date, _title = self.parse_commit(_hash)
+            if _hash in self.shallow:
+                parents = []
+        else:
+            parents, date = self.graph_parents_and_date(position)
+            _title = self.parse_commit(_hash, headers=False)[2]
+        return _hash, date, [(parent, parent) for parent in parents], _title
+
+    # Walk the history of a commit in `git log` order
+    def walk(self, tip):
+        return walk_by_date(tip, self.read)
+
+    # Commits reachable from the tips that are not in the commit cache, as
+    # (hash, date, parents, title)
+    def uncached_commits(self, tips, cache):
+        stack = [tip for tip in tips if cache.lookup(tip) is None]
+        seen = set(stack)
+        while stack:
+            _hash = stack.pop()
+            _, date, parents, _title = self.read(_hash)
+            parents = [parent for parent, _ in parents]
+            yield _hash, date, parents, _title
+            for parent in parents:
+                if parent not in seen and cache.lookup(parent) is None:
+                    seen.add(parent)
+                    stack.append(parent)
+
+    # Finds the best common ancestor of two commits by painting both
+    # histories down in commit date order, returns None if there is none
+    def merge_base(self, source, destination):
+        flags = {source: 1, destination: 2}
+        if source == destination:
+            return source
+        sequence = 0
+        queue = []
+        for _hash in (source, destination):
+            sequence += 1
+            heapq.heappush(
+                queue, (-self.parents_and_date(_hash)[1], sequence, _hash)
+            )
+        while queue:
+            _, _, _hash = heapq.heappop(queue)
+            if flags[_hash] == 3:
+                return _hash
+            for parent in self.parents_and_date(_hash)[0]:
+                previous = flags.get(parent, 0)
+                flags[parent] = previous | flags[_hash]
+                if previous != flags[parent]:
+                    sequence += 1
+                    date = self.parents_and_date(parent)[1]
+                    heapq.heappush(queue, (-date, sequence, parent))
+        return None
+
+
+# Make sure the history of resolved commits is cached, asking git (once, for
+# all tips) only about the commits that are not reachable from an already
+# cached tip. Returns False if the cache can't be used.
+def update_commit_cache(cache, tips, objects=None):
+    tips = [tip for tip in tips if cache.lookup(tip) is None]
+    if not tips:
+        return True
+    if objects is not None:
+        commits = list(objects.uncached_commits(tips, cache))
+        for _hash, date, parents, _title in commits:
+            cache.add(_hash, date, parents, _title)
+        profile_commits('cache_update', len(commits))
+        for tip in tips:
+            cache.add_tip(tip)
+        return cache.save()
+    revisions = tips + ['^' + known for known in cache.tips]
+    log = run(
+        [
+            'git',
+            '--no-pager',
+            'log',
+            '--pretty=format:%H %P %ct%x09%s',
+            '--stdin',
+        ],
+        input=''.join(revision + '\n' for revision in revisions),
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.splitlines()
+    for line in log:
+        head, _, _title = line.partition('\t')
+        fields = head.split()
+        cache.add(fields[0], int(fields[-1]), fields[1:-1], _title)
+    profile_commits('cache_update', len(log))
+    for tip in tips:
+        cache.add_tip(tip)
+    return cache.save()
+
+
+# Run functions on a thread pool (git does the work in subprocesses, so the
+# GIL isn't a bottleneck) and return their results in order
+def run_concurrently(*functions):
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
+
+# Resolve branches to full commit hashes in a single `git cat-file` call.
+# Branches that don't name a commit resolve to None.
+def resolve_branches(branches):
+    with profile_stage('resolve'):
+        lines = run(
+            ['git', 'cat-file', '--batch-check=%(objectname) %(objecttype)'],
+            input=''.join(branch + '\n' for branch in branches),
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.splitlines()
+    hashes = []
+    for i in range(len(branches)):
+        fields = lines[i].split() if i < len(lines) else []
+        if len(fields) == 2 and fields[1] == 'commit':
+            hashes.append(fields[0])
+        else:
+            hashes.append(None)
+    return hashes
+
+
+######################
+### SHALLOW CLONES ###
+######################
+
+# Commits fetched by the first `git fetch --deepen` of a shallow clone, then
+# doubled until the common history is present
+initial_deepen = 32
+
+
+# Commits at the boundary of a shallow clone, git pretends they have no
+# parents. Empty if the repository isn't shallow.
+def read_shallow_commits(git_dir):
+    try:
+        with open(os.path.join(git_dir, 'shallow'), 'r') as f:
+            return set(f.read().split())
+    except OSError:
+        return set()
+
+
+# Whether the common commit of two commits, and the context rows below it,
+# have been fetched
+def has_common_history(source, destination, shallow):
+    merge_base = run(
+        ['git', 'merge-base', source, destination],
+        stdout=PIPE,
+        stderr=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.strip()
+    if not merge_base:
+        return False
+    context = run(
+        [
+            'git',
+            'rev-list',
+            '--max-count={}'.format(trailing_rows + 1),
+            merge_base,
+        ],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.split()
+    return not shallow.intersection(context)
+
+
+# Fetch more history into a shallow clone with exponentially growing
+# `git fetch --deepen` until both commits' common history is present, or
+# there is nothing left to fetch. Returns whether anything was fetched.
+def deepen_history(source, destination):
+    git_dir = git_directory()
+    shallow = read_shallow_commits(git_dir)
+    depth = initial_deepen
+    fetched = False
+    with profile_stage('deepen'):
+        while shallow and not has_common_history(source, destination, shallow):
+            result = run(
+                ['git', 'fetch', '--quiet', '--deepen={}'.format(depth)],
+                check=False,
+            )
+            fetched = True
+            previous, shallow = shallow, read_shallow_commits(git_dir)
+            if result.returncode != 0 or shallow == previous:
+                break
+            depth *= 2
+    return fetched
+
+
+###########################
+### CONFLICT PREDICTION ###
+###########################
+
+# Identity of the throwaway commits that picks are simulated on, fixed so
+# that repeated runs create the same objects
+simulation_identity = {
+    'GIT_AUTHOR_NAME': 'gomp',
+    'GIT_AUTHOR_EMAIL': 'gomp@localhost',
+    'GIT_AUTHOR_DATE': '1000000000 +0000',
+    'GIT_COMMITTER_NAME': 'gomp',
+    'GIT_COMMITTER_EMAIL': 'gomp@localhost',
+    'GIT_COMMITTER_DATE': '1000000000 +0000',
+}
+
+
+# Files changed by each commit (compared to its first parent), in one
+# `git diff-tree --stdin` call
+def read_changed_paths(hashes):
+    lines = run(
+        [
+            'git',
+            'diff-tree',
+            '--stdin',
+            '-r',
+            '--root',
+            '--name-only',
+            '--no-renames',
+            '-m',
+            '--first-parent',
+        ],
+        input=''.join(_hash + '\n' for _hash in hashes),
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+    ).stdout.splitlines()
+    paths = {_hash: set() for _hash in hashes}
+    current = None
+    for line in lines:
+        if line in paths:
+            current = paths[line]
+        elif line and current is not None:
+            current.add(line)
+    return paths
+
+
+# Split picks into groups that change disjoint sets of files. Whether a pick
+# applies then only depends on the earlier picks of its own group, so groups
+# can be simulated independently. Groups keep the order of the picks.
+def group_picks(picks, paths):
+    group = list(range(len(picks)))
+
+    def find(i):
+        while group[i] != i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+
+    last_pick = {}
+    for i, _hash in enumerate(picks):
+        for path in paths[_hash]:
+            if path in last_pick:
+                group[find(i)] = find(last_pick[path])
+            last_pick[path] = i
+    groups = {}
+    for i, _hash in enumerate(picks):
+        groups.setdefault(find(i), []).append(_hash)
+    return list(groups.values())
+
+
+# Cherry-pick commits one after the other on top of `onto`, in memory: each
+# pick is merged with `git merge-tree --write-tree` into a throwaway commit
+# of the current tree whose parent is the pick's own parent, which makes the
+# pick's parent the merge base like in a cherry-pick. Nothing is checked out
+# and no ref moves. Returns {hash: (prediction, conflicted paths)}.
+def simulate_picks(onto, picks, env):
+    tree = onto + '^{tree}'
+    predictions = {}
+    for _hash in picks:
+        if tree is None:
+            predictions[_hash] = (Prediction.unknown, [])
+            continue
+        commit = run(
+            ['git', 'commit-tree', tree, '-p', _hash + '^', '-m', 'gomp'],
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+            check=False,
+            env=env,
+        ).stdout.strip()
+        if not commit:
+            # Root commits have no parent to pick against
+            predictions[_hash] = (Prediction.unknown, [])
+            continue
+        merge = run(
+            [
+                'git',
+                'merge-tree',
+                '--write-tree',
+                '--name-only',
+                '--no-messages',
+                commit,
+                _hash,
+            ],
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+            check=False,
+            env=env,
+        )
+        if merge.returncode not in (0, 1):
+            raise Exception(
+                'git merge-tree --write-tree failed (git 2.38 or newer is '
+                'required): {}'.format(merge.stderr.strip())
+            )
+        lines = merge.stdout.splitlines()
+        if merge.returncode == 0:
+            predictions[_hash] = (Prediction.clean, [])
+            tree = lines[0]
+        else:
+            # Later picks depend on how the conflict is resolved
+            predictions[_hash] = (Prediction.conflict, lines[1:])
+            tree = None
+    return predictions
+
+
+# Predict which picks of a recut apply cleanly on top of `onto`, picking
+# independent groups of commits concurrently. The simulation's objects go
+# to a temporary object directory, so the repository is left untouched.
+def predict_conflicts(onto, picks):
+    with profile_stage('predict_conflicts'):
+        objects = run(
+            ['git', 'rev-parse', '--git-path', 'objects'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.strip()
+        alternates = [os.path.abspath(objects)]
+        if os.environ.get('GIT_ALTERNATE_OBJECT_DIRECTORIES'):
+            alternates.append(os.environ['GIT_ALTERNATE_OBJECT_DIRECTORIES'])
+        groups = group_picks(picks, read_changed_paths(picks))
+        predictions = {}
+        with tempfile.TemporaryDirectory(prefix='gomp-') as directory:
+            env = dict(
+                os.environ,
+                GIT_OBJECT_DIRECTORY=directory,
+                GIT_ALTERNATE_OBJECT_DIRECTORIES=os.pathsep.join(alternates),
+                **simulation_identity,
+            )
+            results = run_concurrently(
+                *[
+                    lambda group=group: simulate_picks(onto, group, env)
+                    for group in groups
+                ]
+            )
+        for result in results:
+            predictions.update(result)
+    profile_commits('predict_conflicts', len(picks))
+    return predictions
+
+
+###################
+### LIBRARY API ###
+###################
+
+
+class BranchNotFound(Exception):
+    def __init__(self, branches):
+        super().__init__(
+            'Branch {} does not exist'.format(', '.join(branches))
+        )
+        self.branches = branches
+
+
+# Everything gomp reads from a repository, shared between comparisons: the
+# commit cache, the native object reader and fully loaded histories
+class Repository:
+    def __init__(self, cache=True, native=False):
+        self.use_cache = cache
+        self.use_native = native
+        self.git_dir = None
+        self.cache = None
+        self.objects = None
+        self.histories = {}
+        self.title_maps = {}
+        self.common_hashes = {}
+        # Resolved branch names, only kept when refs are watched (see Daemon)
+        self.refs = None
+        # Histories loaded as new commits on top of an already loaded one:
+        # {hash: (base hash, number of new commits)}, and the keys whose
+        # commit changed when their title map was extended from the base's
+        self.extensions = {}
+        self.changed_keys = {}
+        # Last result of comparing each (src, dest) pair of branches
+        self.comparisons = {}
+
+    # Locate the git directory, and open the cache and object reader
+    def open(self):
+        if self.git_dir is not None or not (self.use_cache or self.use_native):
+            return
+        self.git_dir = git_directory()
+        # Commits at the boundary of a shallow clone look like root commits,
+        # and would stay that way in the cache once history is deepened
+        if self.use_cache and not read_shallow_commits(self.git_dir):
+            self.cache = CommitCache(os.path.join(self.git_dir, 'gomp-cache'))
+        # Without a commit-graph, fall back to reading history through git
+        if self.use_native:
+            self.objects = NativeRepository.open(self.git_dir)
+
+    # Make sure the history of resolved commits can be walked from the cache
+    def prepare(self, tips):
+        if self.cache is not None:
+            with profile_stage('cache_update'):
+                updated = update_commit_cache(self.cache, tips, self.objects)
+            if not updated:
+                self.cache = None
+
+    # Walk a prepared commit in-process, returns None to read it from git
+    def walk(self, _hash):
+        if self.cache is not None:
+            walk = self.cache.walk(_hash)
+            if walk is not None:
+                return walk
+        if self.objects is not None:
+            return self.objects.walk(_hash)
+        return None
+
+    # Full history of a resolved commit, loaded once and then shared
+    def history(self, _hash):
+        if _hash not in self.histories:
+            self.histories[_hash] = read_history(_hash, self)
+        return self.histories[_hash]
+
+    # Load the history of a commit that fast-forwarded from an already loaded
+    # `base` by only reading the new commits. Returns False if it didn't.
+    def extend(self, _hash, base):
+        if _hash in self.histories:
+            return True
+        if base not in self.histories:
+            return False
+        commits = read_fast_forward(base, _hash)
+        if commits is None:
+            return False
+        self.histories[_hash] = History(commits) + self.histories[base]
+        self.extensions[_hash] = (base, len(commits))
+        return True
+
+    # Resolve branches to hashes (see resolve_branches)
+    def resolve(self, branches):
+        if self.refs is None:
+            return resolve_branches(branches)
+        unknown = [branch for branch in branches if branch not in self.refs]
+        if unknown:
+            self.refs.update(zip(unknown, resolve_branches(unknown)))
+        return [self.refs[branch] for branch in branches]
+
+    # Title map (see create_title_map) of a full history, built once, or
+    # extended from the title map of the history it fast-forwarded from
+    def title_map(self, _hash):
+        if _hash not in self.title_maps:
+            base, count = self.extensions.get(_hash, (None, 0))
+            if base in self.title_maps:
+                self.title_maps[_hash], self.changed_keys[_hash] = (
+                    extend_title_map(
+                        *self.title_maps[base], self.history(_hash), count
+                    )
+                )
+            else:
+                self.title_maps[_hash] = create_title_map(self.history(_hash))
+        return self.title_maps[_hash]
+
+    # Forget everything that is reloaded on demand
+    def clear(self):
+        self.histories.clear()
+        self.title_maps.clear()
+        self.extensions.clear()
+        self.changed_keys.clear()
+        self.comparisons.clear()
+
+    # Fetch the common history of two commits in a shallow clone (see
+    # deepen_history). The object database changes, so it is opened again.
+    def deepen(self, source, destination):
+        if deepen_history(source, destination):
+            self.clear()
+            self.common_hashes.clear()
+            self.git_dir = None
+            self.cache = None
+            self.objects = None
+            self.open()
+
+
+# Compares the history of two branches, the library equivalent of running
+# `gomp src dest`:
+#     comparison = HistoryComparison('feature', 'main').load()
+#     for source_row, destination_row in comparison.side_by_side():
+#         ...
+# Pass the same Repository to several comparisons to share loaded histories.
+class HistoryComparison:
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+        self,
+        src,
+        dest,
+        repository=None,
+        bounded=False,
+        match=Match.title,
+        engine=Engine.walk,
+        deepen=False,
+        first_parent=False,
+        topo_order=False,
+        align=False,
+        fuzzy=None,
+        contained_in=None,
+    ):
+        self.src = src
+        self.dest = dest
+        self.repository = repository if repository is not None else Repository()
+        self.bounded = bounded
+        self.match = match
+        self.engine = engine
+        # Fetch the common history of shallow clones first
+        self.deepen = deepen
+        # How the DAG engine walks both branches (see read_dag_histories)
+        self.first_parent = first_parent
+        self.topo_order = topo_order
+        # Align matching commits in the side by side view (see align_rows)
+        self.align = align
+        # Similarity threshold of reworded titles (see match_fuzzy_rows)
+        self.fuzzy = fuzzy
+        # Pattern of the refs rows are annotated with (see
+        # annotate_containing_refs)
+        self.contained_in = contained_in
+        self.dag_histories = None
+        self.rows = None
+        self.source_hash = None
+        self.destination_hash = None
+        self.source_history = None
+        self.destination_history = None
+        self.commit_keys = None
+        self.common_hash = None
+
+    # Resolve both branches and read their history. Raises BranchNotFound.
+    def load(self):
+        if self.source_history is not None:
+            return self
+        # Resolve both branches once, history is then read from these hashes
+        # so that a ref moving while gomp runs can't mix two different states
+        hashes, _ = run_concurrently(
+            lambda: self.repository.resolve([self.src, self.dest]),
+            self.repository.open,
+        )
+        missing = [
+            branch
+            for branch, _hash in zip([self.src, self.dest], hashes)
+            if _hash is None
+        ]
+        if missing:
+            raise BranchNotFound(missing)
+        self.source_hash, self.destination_hash = hashes
+        if self.deepen:
+            self.repository.deepen(*hashes)
+        try:
+            self.read()
+        except (OSError, ValueError, KeyError, struct.error):
+            if self.repository.objects is None:
+                raise
+            # The object database could not be read natively, ask git instead
+            self.repository.objects = None
+            self.read()
+        return self
+
+    # Grab the history of both branches (and patch-ids) concurrently
+    def read(self):
+        repository = self.repository
+        hashes = [self.source_hash, self.destination_hash]
+        if self.engine == Engine.cherry_mark:
+            rows = read_cherry_mark_rows(*hashes)
+            self.common_hash = rows[2]
+            self.source_history, self.destination_history = [
+                History(side) for side in rows[:2]
+            ]
+            self.rows = self.annotate(*rows[:2])
+            return
+        if self.engine == Engine.rewrite:
+            *rows, self.common_hash, self.commit_keys = read_rewrite_rows(
+                *hashes, repository
+            )
+            self.source_history, self.destination_history = [
+                History(side) for side in rows
+            ]
+            self.rows = self.annotate(*rows)
+            return
+        # With a commit-graph this is cheap, and saves walking unrelated
+        # histories all the way down
+        if repository.objects is not None:
+            if repository.objects.merge_base(*hashes) is None:
+                raise Exception('The branches share no common history!')
+        dag = self.engine == Engine.dag
+        # Branches that only fast-forwarded since they were last compared
+        # just read their new commits
+        previous = repository.comparisons.get((self.src, self.dest))
+        if previous is not None and not self.bounded:
+            run_concurrently(
+                lambda: repository.extend(hashes[0], previous.source_hash),
+                lambda: repository.extend(
+                    hashes[1], previous.destination_hash
+                ),
+            )
+            repository.prepare(
+                [_hash for _hash in hashes if _hash not in repository.histories]
+            )
+        elif not self.bounded and not dag:
+            # Bounded and DAG loads only read the commits down to the fork,
+            # caching the full history of both branches would cost more
+            repository.prepare(hashes)
+        loaders = []
+        if dag:
+            loaders.append(
+                lambda: read_dag_histories(
+                    *hashes, repository, self.first_parent, self.topo_order
+                )
+            )
+        if self.bounded and not dag:
+            loaders.append(lambda: read_bounded_histories(*hashes, repository))
+        elif not self.bounded:
+            loaders.append(lambda: repository.history(hashes[0]))
+            loaders.append(lambda: repository.history(hashes[1]))
+        if self.match == Match.patch_id:
+            loaders.append(lambda: read_patch_id_keys(*hashes, repository))
+        results = run_concurrently(*loaders)
+        if self.match == Match.patch_id:
+            self.commit_keys = results.pop()
+            if repository.cache is not None:
+                repository.cache.save()
+        if dag:
+            *self.dag_histories, self.common_hash = results.pop(0)
+            # Bounded, commits are only matched within the walked rows
+            if self.bounded:
+                results = self.dag_histories
+        elif self.bounded:
+            results = results[0]
+        self.source_history, self.destination_history = results
+
+    def find_common_hash(self):
+        if self.common_hash is None:
+            self.load()
+            # Full histories are shared, and so is their common hash
+            shared = not self.bounded and self.engine == Engine.walk
+            key = (self.source_hash, self.destination_hash)
+            if shared and key in self.repository.common_hashes:
+                self.common_hash = self.repository.common_hashes[key]
+                return self.common_hash
+            with profile_stage('common_hash'):
+                self.common_hash = find_first_common_hash(
+                    self.source_history, self.destination_history
+                )
+            if shared:
+                self.repository.common_hashes[key] = self.common_hash
+        return self.common_hash
+
+    # Title maps of full histories are shared through the repository
+    def title_maps(self):
+        if self.bounded or self.match != Match.title:
+            return None
+        return (
+            self.repository.title_map(self.source_hash),
+            self.repository.title_map(self.destination_hash),
+        )
+
+    # Rows of both branches (see compute_diff_lists), computed once. The
+    # result of comparing full histories by title is kept on the repository:
+    # when the branches are compared again after fast-forwarding, only rows
+    # whose title changed in the title maps are classified again.
+    def diff_lists(self):
+        self.load()
+        if self.rows is not None:
+            return self.rows
+        title_maps = self.title_maps()
+        if self.engine == Engine.dag:
+            self.rows = self.annotate(
+                *compute_dag_diff_lists(
+                    self.dag_histories,
+                    (self.source_history, self.destination_history),
+                    self.common_hash,
+                    self.commit_keys,
+                    title_maps,
+                )
+            )
+            return self.rows
+        self.rows = compute_diff_lists(
+            self.source_history,
+            self.destination_history,
+            self.find_common_hash(),
+            self.commit_keys,
+            title_maps,
+            self.previous_rows(),
+        )
+        if title_maps is not None:
+            self.repository.comparisons[(self.src, self.dest)] = (
+                ComparisonResult(
+                    self.source_hash, self.destination_hash, *self.rows
+                )
+            )
+        self.rows = self.annotate(*self.rows)
+        return self.rows
+
+    # Pair up reworded commits (see match_fuzzy_rows) when matching fuzzily,
+    # and name the refs containing each row (see annotate_containing_refs)
+    def annotate(self, source_rows, destination_rows):
+        rows = source_rows, destination_rows
+        if self.fuzzy is not None:
+            rows = match_fuzzy_rows(*rows, self.fuzzy)
+        if self.contained_in is not None:
+            rows = annotate_containing_refs(
+                *rows,
+                self.contained_in,
+                [self.source_hash, self.destination_hash],
+            )
+        return rows
+
+    # Rows of the last comparison of the same branches that are still valid,
+    # with the keys whose commit changed since (see compute_diff_lists)
+    def previous_rows(self):
+        repository = self.repository
+        previous = repository.comparisons.get((self.src, self.dest))
+        if previous is None or self.title_maps() is None:
+            return None
+        changed_keys = set()
+        for base, _hash in [
+            (previous.source_hash, self.source_hash),
+            (previous.destination_hash, self.destination_hash),
+        ]:
+            if base == _hash:
+                continue
+            # A history that was rewritten is compared from scratch
+            extended_from, _ = repository.extensions.get(_hash, (None, 0))
+            if extended_from != base or _hash not in repository.changed_keys:
+                return None
+            changed_keys |= repository.changed_keys[_hash]
+        rows = (previous.source_rows, previous.destination_rows)
+        return rows, changed_keys
+
+    # (source row, destination row) pairs of the side by side view
+    def side_by_side(self):
+        return list(self.iter_side_by_side())
+
+    # The same pairs, generated as they are consumed
+    def iter_side_by_side(self):
+        # Both versions of a rewritten commit share a line
+        if self.align or self.engine == Engine.rewrite:
+            return align_rows(*self.diff_lists(), self.commit_keys)
+        return pair_rows(*self.diff_lists())
+
+    # Rows of the recut offer, newest first
+    def recut(self):
+        return recut_rows(*self.diff_lists())
+
+    # Whether each pick of the recut offer applies cleanly on top of dest,
+    # as {hash: (Prediction, conflicted paths)} (see predict_conflicts)
+    def predict_conflicts(self):
+        picks = [
+            row.hash
+            for row in reversed(self.recut())
+            if row.status == Status.src_new
+        ]
+        return predict_conflicts(self.destination_hash, picks)
+
+
+# Count the commits of a comparison without reading titles or history: git
+# counts both sides of the symmetric difference (--cherry-mark sets patch
+# equivalent commits apart) while a second walk measures the depth of the
+# fork point. Returns a Stat. Raises BranchNotFound.
+def compare_stat(src, dest):
+    hashes = resolve_branches([src, dest])
+    missing = [
+        branch for branch, _hash in zip([src, dest], hashes) if _hash is None
+    ]
+    if missing:
+        raise BranchNotFound(missing)
+    source, destination = hashes
+    counts, depth = run_concurrently(
+        lambda: count_revisions(
+            ['--left-right', '--cherry-mark', source + '...' + destination]
+        ),
+        lambda: count_revisions(
+            ['--first-parent', destination, '^' + source]
+        ),
+    )
+    return Stat(*(counts + depth))
+
+
+# Counts printed by `git rev-list --count`
+def count_revisions(revisions):
+    with profile_stage('count'):
+        output = run(
+            ['git', 'rev-list', '--count'] + revisions,
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+    return [int(count) for count in output.split()]
+
+
+# Compare each branch against a base branch. The base history and its title
+# map are only loaded once; each branch then only costs a walk of its
+# divergence from the base, and branches are processed concurrently.
+# Returns a BranchSummary per branch. Raises BranchNotFound.
+def compare_matrix(base, branches, repository=None, match=Match.title):
+    if repository is None:
+        repository = Repository()
+    hashes, _ = run_concurrently(
+        lambda: repository.resolve([base] + branches), repository.open
+    )
+    missing = [
+        branch
+        for branch, _hash in zip([base] + branches, hashes)
+        if _hash is None
+    ]
+    if missing:
+        raise BranchNotFound(missing)
+    base_hash = hashes[0]
+    base_title_map = None
+    if match == Match.title:
+        # Branches are only read down to the fork by summarize_branch
+        repository.prepare([base_hash])
+        base_title_map = repository.title_map(base_hash)[0]
+    summaries = run_concurrently(
+        *[
+            lambda branch=branch, _hash=_hash: summarize_branch(
+                branch, _hash, base_hash, base_title_map, repository
+            )
+            for branch, _hash in zip(branches, hashes[1:])
+        ]
+    )
+    if repository.cache is not None:
+        repository.cache.save()
+    return summaries
+
+
+# Count the commits of a branch ahead of and behind the base. Commits ahead
+# are similar if their title is in the base history, or, without a base
+# title map, if their patch-id matches one of the commits behind.
+def summarize_branch(
+    branch, branch_hash, base_hash, base_title_map, repository
+):
+    # pylint: disable=too-many-arguments
+    with profile_stage('load'):
+        lines = run(
+            [
+                'git',
+                '--no-pager',
+                'log',
+                '--left-right',
+                '--pretty=format:%m%H%x09%s',
+                base_hash + '...' + branch_hash,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.splitlines()
+    profile_commits('load', len(lines))
+    ahead = []
+    behind = []
+    for line in lines:
+        head, _, _title = line.partition('\t')
+        commit = [head[1:], _title]
+        if head[0] == '>':
+            ahead.append(commit)
+        else:
+            behind.append(commit)
+    if base_title_map is not None:
+        similar = [commit for commit in ahead if commit[1] in base_title_map]
+    else:
+        keys = read_patch_id_keys(base_hash, branch_hash, repository)
+        behind_keys = {
+            keys[commit[0]] for commit in behind if commit[0] in keys
+        }
+        similar = [
+            commit for commit in ahead if keys.get(commit[0]) in behind_keys
+        ]
+    return BranchSummary(branch, len(ahead), len(behind), len(similar))
+
+
+##############
+### DAEMON ###
+##############
+
+# Keeps repositories (loaded histories, title maps, common hashes and
+# resolved refs) in memory and serves gomp commands over a Unix domain socket
+# in the git directory. Everything but the resolved refs is keyed by commit
+# hash and never goes stale; before each request, resolved refs are dropped
+# when a ref they may have resolved through changed.
+class Daemon:
+    max_histories = 32
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.git_dir = git_directory()
+        # Found the same way clients look for it
+        self.path = daemon_socket_path()
+        if self.path is None:
+            raise Exception('The gomp daemon must run in a working tree')
+        # A linked worktree has its own HEAD, outside of the common git dir
+        head = run(
+            ['git', 'rev-parse', '--git-path', 'HEAD'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout.strip()
+        self.head = os.path.abspath(head)
+        self.repositories = {}
+        self.ref_state = self.read_ref_state()
+
+    # Identity of the worktree's HEAD, packed-refs and every loose ref. Git
+    # replaces ref files rather than rewriting them, so a new inode also
+    # reveals updates made within the resolution of the modification time.
+    def read_ref_state(self):
+        paths = ['packed-refs']
+        refs = os.path.join(self.git_dir, 'refs')
+        for directory, _, files in os.walk(refs):
+            for name in files:
+                path = os.path.join(directory, name)
+                path = os.path.relpath(path, self.git_dir)
+                paths.append(path.replace(os.sep, '/'))
+        files = {path: os.path.join(self.git_dir, path) for path in paths}
+        files['HEAD'] = self.head
+        state = {}
+        for path, _file in files.items():
+            try:
+                stat = os.stat(_file)
+                state[path] = (stat.st_ino, stat.st_mtime_ns)
+            except OSError:
+                pass
+        return state
+
+    # Drop the resolved names that may depend on a ref that changed, and
+    # those that don't resolve through the watched refs at all
+    def invalidate(self):
+        state = self.read_ref_state()
+        changed = [
+            path
+            for path in set(state) | set(self.ref_state)
+            if state.get(path) != self.ref_state.get(path)
+        ]
+        self.ref_state = state
+        # A ref can be named by its full path, or without refs/ and its kind.
+        # HEAD (and @) follow the checked out branch, which may have moved.
+        names = {'HEAD', ''} if changed else set()
+        for path in changed:
+            parts = path.split('/')
+            for start in range(3):
+                names.add('/'.join(parts[start:]))
+        everything = 'packed-refs' in changed
+        for repository in self.repositories.values():
+            for branch in list(repository.refs):
+                if (
+                    everything
+                    or not watched_name(branch)
+                    or re.split(r'[~^@:]', branch)[0] in names
+                ):
+                    del repository.refs[branch]
+
+    def repository(self, args):
+        key = (args.no_cache, args.native)
+        if key not in self.repositories:
+            repository = Repository(cache=not args.no_cache, native=args.native)
+            repository.refs = {}
+            self.repositories[key] = repository
+        repository = self.repositories[key]
+        # Histories are reloaded on demand, keep memory bounded
+        if len(repository.histories) > self.max_histories:
+            repository.clear()
+        return repository
+
+    # Parse a request's arguments as process_commands would. Returns None
+    # when the command must run in-process: usage errors and help, commands
+    # that don't compare branches, or a width the client couldn't tell.
+    def parse_request(self, request):
+        try:
+            with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+                args = self.parser.parse_args(request['argv'])
+                check_args(self.parser, args)
+        except SystemExit:
+            return None
+        if args.daemon or args.no_daemon or args.profile is not None:
+            return None
+        if args.stat:
+            return None
+        if needs_terminal_width(args) and request['columns'] is None:
+            return None
+        return args
+
+    # Run one request: a JSON line with the arguments, whether the client's
+    # stdout is a terminal, its width and pager settings. Answered with a
+    # JSON header line, the pager to use or a request to run the command
+    # in-process, then the command's output.
+    def handle(self, rfile, wfile):
+        line = rfile.readline().decode('utf-8')
+        if not line.strip():
+            # A connection only checking whether the daemon is running
+            return
+        request = json.loads(line)
+        args = self.parse_request(request)
+        output = io.TextIOWrapper(wfile, encoding='utf-8', write_through=True)
+        try:
+            if args is None:
+                output.write(json.dumps({'local': True}) + '\n')
+                return
+            pager = None
+            if request['terminal'] and paged(args):
+                env = {
+                    name: value
+                    for name, value in os.environ.items()
+                    if name not in ('GIT_PAGER', 'PAGER')
+                }
+                env.update(request['environment'])
+                pager = git_pager(env)
+            output.write(json.dumps({'pager': pager}) + '\n')
+            self.invalidate()
+            line_length = terminal_width(args, request['columns'])
+            with redirect_stdout(output):
+                run_views(args, self.repository(args), line_length)
+        except BrokenPipeError:
+            # The client stopped reading
+            pass
+        except Exception as error:  # pylint: disable=broad-except
+            print('gomp daemon: {}'.format(error), file=output)
+        finally:
+            output.detach()
+
+    def serve(self):
+        probe = query_daemon_socket(self.path)
+        if probe is not None:
+            probe.close()
+            raise Exception('A gomp daemon is already running')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socketserver.UnixStreamServer(self.path, DaemonRequestHandler)
+        server.daemon = self
+        # Exit through the finally clause so the socket is removed
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.path)
+
+
+# Whether a name resolves through the refs the daemon watches (see
+# Daemon.read_ref_state). Pseudo-refs like ORIG_HEAD or FETCH_HEAD live
+# elsewhere in the git directory, and reflog or upstream names like
+# `feature@{1}` or `@{u}` also depend on reflogs and the config.
+def watched_name(name):
+    base = re.split(r'[~^:]', name)[0]
+    if '@' in base:
+        return False
+    return base == 'HEAD' or not re.fullmatch(r'[A-Z_]+', base)
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.daemon.handle(self.rfile, self.wfile)
+
+
+# Basic command input parser
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'src', nargs='?', default='HEAD', help='Left side branch'
+    )
+    parser.add_argument('dest', nargs='?', help='Right side branch')
+    parser.add_argument(
+        '--key', help='Display with color code', action='store_true'
+    )
+    parser.add_argument('--recut', help='Recut view', action='store_true')
+    parser.add_argument(
+        '--predict-conflicts',
+        help='Show whether each pick of the recut view applies cleanly',
+        action='store_true',
+    )
+    parser.add_argument('--cols', help='Number of columns')
+    parser.add_argument(
+        '--bounded',
+        help='Only load history down to the common hash plus context',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--match',
+        help='Match commits across branches by title or by patch-id',
+        choices=[Match.title, Match.patch_id],
+        default=Match.title,
+    )
+    parser.add_argument(
+        '--engine',
+        help='Compare in gomp (walk), from one `git log --cherry-mark` walk of '
+        'the commits only on either branch (matching by patch-id), or by '
+        'listing each branch down to their merge-base (dag, for merge-heavy '
+        'histories)',
+        choices=[Engine.walk, Engine.cherry_mark, Engine.dag],
+        default=Engine.walk,
+    )
+    parser.add_argument(
+        '--fuzzy',
+        help='Also match commits only on one side by similar titles, at least '
+        'THRESHOLD similar (default {})'.format(fuzzy_threshold),
+        nargs='?',
+        const=fuzzy_threshold,
+        type=float,
+        metavar='THRESHOLD',
+    )
+    parser.add_argument(
+        '--contained-in',
+        help='Show which refs matching PATTERN (e.g. release/*) contain each '
+        'commit',
+        metavar='PATTERN',
+    )
+    parser.add_argument(
+        '--align',
+        help='Align matching commits side by side and show which ones moved',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--first-parent',
+        help='Only follow the first parent of merges, folding merged branches '
+        'into their merge commit (implies --engine dag)',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--topo-order',
+        help='List the commits of merged branches together rather than by '
+        'date (implies --engine dag)',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--rewrite',
+        help='Compare a branch before and after it was rewritten, e.g. '
+        '`gomp feature@{1} feature --rewrite` after a rebase',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--deepen',
+        help='In a shallow clone, fetch history until the common hash is found',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='Do not use the commit cache in .git/gomp-cache',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--native',
+        help='Read history from the commit-graph without spawning git',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--matrix',
+        help='Summarize how each branch compares to the first one (the base)',
+        nargs='+',
+        metavar='BRANCH',
+    )
+    parser.add_argument(
+        '--views',
+        help='With --matrix, also show each branch side by side with the base',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--stat',
+        help='Only count commits on either branch, similar commits and the '
+        'depth of the fork point on dest',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--format',
+        help='Output format: text, a JSON array of rows (or of the --stat '
+        'counts), or one JSON row per line',
+        choices=[Format.text, Format.json, Format.ndjson],
+        default=Format.text,
+    )
+    parser.add_argument(
+        '--no-pager',
+        help='Do not pipe the output into a pager',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--profile',
+        help='Report per-stage timings, subprocesses and peak memory on '
+        'stderr, or as JSON to FILE (also set by $GOMP_PROFILE)',
+        nargs='?',
+        const='-',
+        metavar='FILE',
+    )
+    parser.add_argument(
+        '--daemon',
+        help='Serve gomp commands for this repository, keeping histories in '
+        'memory between runs',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-daemon',
+        help='Run in this process even if a daemon is serving the repository',
+        action='store_true',
+    )
+    return parser
+
+
+# Run a command. Unless forward is False, the repository's daemon runs it
+# when one is running (gomp.client forwards commands before importing gomp).
+def process_commands(forward=True):
+    if forward and query_daemon(sys.argv[1:]):
+        return
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.daemon:
+        if not hasattr(socket, 'AF_UNIX'):
+            parser.error('--daemon requires Unix domain sockets')
+        Daemon(parser).serve()
+        return
+
+    check_args(parser, args)
+    columns = None
+    if needs_terminal_width(args):
+        columns = int(os.get_terminal_size().columns)
+    line_length = terminal_width(args, columns)
+    profile = args.profile
+    if profile is None:
+        profile = profile_setting()
+
+    with profiling(profile):
+        if args.stat:
+            process_stat(args)
+            return
+        with paging(paged(args)):
+            repository = Repository(cache=not args.no_cache, native=args.native)
+            run_views(args, repository, line_length)
+
+
+# Reject argument combinations argparse can't express
+def check_args(parser, args):
+    if args.matrix is not None and len(args.matrix) < 2:
+        parser.error('--matrix needs a base and at least one branch')
+    if args.matrix is not None:
+        reject_options(
+            parser,
+            '--matrix',
+            [
+                ('src and dest', args.src != 'HEAD' or args.dest is not None),
+                ('--key', args.key),
+                ('--recut', args.recut),
+                ('--predict-conflicts', args.predict_conflicts),
+                ('--align', args.align),
+                ('--fuzzy', args.fuzzy is not None),
+                ('--engine', args.engine != Engine.walk),
+                ('--first-parent', args.first_parent),
+                ('--topo-order', args.topo_order),
+            ],
+        )
+    if args.matrix is None and args.dest is None:
+        parser.error('the following arguments are required: dest')
+    if args.matrix is not None and args.stat:
+        parser.error('--stat compares two branches, not --matrix')
+    if args.stat:
+        reject_options(
+            parser,
+            '--stat',
+            [
+                ('--key', args.key),
+                ('--recut', args.recut),
+                ('--predict-conflicts', args.predict_conflicts),
+                ('--bounded', args.bounded),
+                ('--match', args.match != Match.title),
+                ('--align', args.align),
+                ('--fuzzy', args.fuzzy is not None),
+                ('--engine', args.engine != Engine.walk),
+                ('--first-parent', args.first_parent),
+                ('--topo-order', args.topo_order),
+            ],
+        )
+    if args.views and (args.matrix is None or args.format != Format.text):
+        parser.error('--views only applies to the text output of --matrix')
+    if args.deepen and (args.matrix is not None or args.stat):
+        parser.error('--deepen compares two branches, not --matrix or --stat')
+    if args.engine == Engine.cherry_mark and (
+        args.first_parent or args.topo_order
+    ):
+        parser.error('--first-parent and --topo-order need --engine dag')
+    if args.contained_in is not None and (
+        args.matrix is not None or args.stat
+    ):
+        parser.error('--contained-in annotates rows, not --matrix or --stat')
+    if args.rewrite and (
+        args.recut
+        or args.matrix is not None
+        or args.stat
+        or args.engine != Engine.walk
+        or args.first_parent
+        or args.topo_order
+    ):
+        parser.error('--rewrite only compares two branches side by side')
+    if args.predict_conflicts and not args.recut:
+        parser.error('--predict-conflicts requires --recut')
+
+
+# Reject the options a mode ignores, given as (option, whether it was given)
+def reject_options(parser, mode, options):
+    given = [option for option, used in options if used]
+    if given:
+        parser.error('{} does not take {}'.format(mode, ', '.join(given)))
+
+
+# Only text views are sized, to the terminal unless --cols is given
+def needs_terminal_width(args):
+    return args.cols is None and args.format == Format.text and not args.stat
+
+
+def terminal_width(args, columns):
+    if args.cols is not None:
+        return int(args.cols)
+    return columns if needs_terminal_width(args) else None
+
+
+def paged(args):
+    return not args.no_pager and args.format == Format.text
+
+
+def run_views(args, repository, line_length):
+    if args.matrix is not None:
+        process_matrix(args, repository, line_length)
+    else:
+        process_comparison(args, repository, line_length)
+
+
+# Send stdout through the user's pager (GIT_PAGER, core.pager or PAGER, as
+# git picks it) while the block runs, when stdout is a terminal
+@contextmanager
+def paging(enabled=True):
+    pager = git_pager() if enabled and sys.stdout.isatty() else None
+    with pipe_to_pager(pager):
+        yield
+
+
+def git_pager(env=None):
+    return run(
+        ['git', 'var', 'GIT_PAGER'],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+        env=env,
+    ).stdout.strip()
+
+
+def process_comparison(args, repository, line_length):
+    src = args.src
+    dest = args.dest
+    engine = args.engine
+    if args.first_parent or args.topo_order:
+        engine = Engine.dag
+    if args.rewrite:
+        engine = Engine.rewrite
+    comparison = HistoryComparison(
+        src,
+        dest,
+        repository,
+        bounded=args.bounded,
+        match=args.match,
+        engine=engine,
+        deepen=args.deepen,
+        first_parent=args.first_parent,
+        topo_order=args.topo_order,
+        align=args.align,
+        fuzzy=args.fuzzy,
+        contained_in=args.contained_in,
+    )
+
+    try:
+        comparison.load()
+    except BranchNotFound as error:
+        if src in error.branches:
+            print(
+                'Branch {} does not exist'.format(
+                    colorize(src, BColors.SRC_NEW)
+                )
+            )
+        if dest in error.branches:
+            print(
+                'Branch {} does not exist'.format(
+                    colorize(dest, BColors.DEST_NEW)
+                )
+            )
+        # Check if src and dest exist
+        print(
+            'Local may not be synced with remote, please run {} and try again'.format(
+                colorize('git fetch', BColors.COMMON)
+            )
+        )
+        print('')
+        return
+
+    if args.format != Format.text:
+        if args.recut:
+            predictions = None
+            if args.predict_conflicts:
+                predictions = comparison.predict_conflicts()
+            records = recut_records(comparison.recut(), predictions)
+        else:
+            records = side_by_side_records(comparison.iter_side_by_side())
+        print_records(records, args.format)
+        return
+
+    print('')
+    cmd = Commands.show_side_by_side
+    # Display with color code
+    if args.key:
+        print_color_key(src, dest, args.align or args.rewrite)
+    # Display with color code
+    if args.recut:
+        cmd = Commands.offset_recut
+    # Run the proper command
+    if cmd == Commands.show_side_by_side:
+        show_side_by_side(comparison, line_length)
+    elif cmd == Commands.offset_recut:
+        show_recut_offer(comparison, line_length, args.predict_conflicts)
+    print('')
+
+
+def print_missing_branches(branches):
+    for branch in branches:
+        print('Branch {} does not exist'.format(colorize(branch, BColors.BOLD)))
+    print(
+        'Local may not be synced with remote, please run {} and try again'.format(
+            colorize('git fetch', BColors.COMMON)
+        )
+    )
+    print('')
+
+
+def process_stat(args):
+    try:
+        stat = compare_stat(args.src, args.dest)
+    except BranchNotFound as error:
+        print_missing_branches(error.branches)
+        return
+    if args.format != Format.text:
+        print(json.dumps(dict(src=args.src, dest=args.dest, **stat._asdict())))
+    else:
+        print(
+            ' '.join(
+                '{}={}'.format(field, count)
+                for field, count in stat._asdict().items()
+            )
+        )
+
+
+def process_matrix(args, repository, line_length):
+    base, branches = args.matrix[0], args.matrix[1:]
+    try:
+        summaries = compare_matrix(base, branches, repository, args.match)
+    except BranchNotFound as error:
+        print_missing_branches(error.branches)
+        return
+    if args.format != Format.text:
+        print_records(
+            (summary._asdict() for summary in summaries), args.format
+        )
+        return
+    print('')
+    show_matrix(base, summaries, line_length)
+    print('')
+    if not args.views:
+        return
+    for branch in branches:
+        comparison = HistoryComparison(
+            branch, base, repository, bounded=args.bounded, match=args.match
+        )
+        show_side_by_side(comparison.load(), line_length)
+        print('')
 
 
 if __name__ == '__main__':
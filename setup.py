@@ -13,7 +13,7 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://www.markforged.com",
     packages=setuptools.find_packages(),
-    entry_points={"console_scripts": ["gomp=gomp.gomp:process_commands"]},
+    entry_points={"console_scripts": ["gomp=gomp.client:main"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
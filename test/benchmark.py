@@ -0,0 +1,365 @@
+from subprocess import run, Popen, PIPE
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+GOMP_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, GOMP_ROOT)
+from gomp.gomp import (
+    compute_side_by_side,
+    create_title_map,
+    find_first_common_hash,
+    format_side_by_side,
+    match_fuzzy_titles,
+    process_history,
+    resolve_branches,
+)
+
+# Titles reused by the duplicate-title fraction of the shared history
+DUPLICATE_TITLES = ['Fix typo', 'Update dependencies', 'Fix lint', 'WIP']
+BASE_DATE = 1500000000
+NUM_COLS = 80
+FUZZY_THRESHOLD = 0.7
+
+
+# Path and content of the file added by commit `number`. Paths fan out over
+# two directory levels so trees stay small on deep histories.
+def commit_change(number):
+    path = '{:02x}/{:02x}/{}'.format(number % 256, number // 256 % 256, number)
+    return path, '{}\n'.format(number)
+
+
+def fast_import_commit(ref, mark, parent, date, _title, change):
+    path, content = change
+    message = _title.encode() + b'\n'
+    data = content.encode()
+    lines = [
+        'commit {}'.format(ref).encode(),
+        'mark :{}'.format(mark).encode(),
+        'committer Bench <bench@example.com> {} +0000'.format(date).encode(),
+        'data {}'.format(len(message)).encode(),
+        message,
+    ]
+    if parent is not None:
+        lines.append('from :{}'.format(parent).encode())
+    lines.append('M 100644 inline {}'.format(path).encode())
+    lines.append('data {}'.format(len(data)).encode())
+    lines.append(data)
+    return b'\n'.join(lines)
+
+
+# Generate a repository with `depth` shared commits, after which `main` and
+# `feature` both gain `divergence` commits. A `cherry_pick_ratio` fraction of
+# the feature commits are cherry-picks of main commits (same title and same
+# change), and a `duplicate_ratio` fraction of the shared commits reuse a
+# common title.
+def generate_history(
+    path, depth, divergence, cherry_pick_ratio, duplicate_ratio, seed=0
+):
+    # pylint: disable=too-many-arguments,too-many-locals
+    rng = random.Random(seed)
+    run(['git', 'init', '-q', path], check=True)
+    importer = Popen(['git', 'fast-import', '--quiet'], stdin=PIPE, cwd=path)
+    mark = 0
+    for number in range(depth):
+        mark += 1
+        if rng.random() < duplicate_ratio:
+            _title = rng.choice(DUPLICATE_TITLES)
+        else:
+            _title = 'Commit {}'.format(number)
+        importer.stdin.write(
+            fast_import_commit(
+                'refs/heads/main',
+                mark,
+                mark - 1 if mark > 1 else None,
+                BASE_DATE + mark,
+                _title,
+                commit_change(number),
+            )
+        )
+    fork = mark
+    main_commits = []
+    for number in range(depth, depth + divergence):
+        mark += 1
+        _title = 'Main commit {}'.format(number)
+        main_commits.append((_title, number))
+        importer.stdin.write(
+            fast_import_commit(
+                'refs/heads/main',
+                mark,
+                mark - 1,
+                BASE_DATE + mark,
+                _title,
+                commit_change(number),
+            )
+        )
+    importer.stdin.write(
+        'reset refs/heads/feature\nfrom :{}\n'.format(fork).encode()
+    )
+    parent = fork
+    for number in range(depth + divergence, depth + 2 * divergence):
+        mark += 1
+        if main_commits and rng.random() < cherry_pick_ratio:
+            _title, picked = main_commits.pop(rng.randrange(len(main_commits)))
+        else:
+            _title, picked = 'Feature commit {}'.format(number), number
+        importer.stdin.write(
+            fast_import_commit(
+                'refs/heads/feature',
+                mark,
+                parent,
+                BASE_DATE + mark,
+                _title,
+                commit_change(picked),
+            )
+        )
+        parent = mark
+    importer.stdin.close()
+    if importer.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+
+def git_log(branch):
+    return run(
+        ['git', '--no-pager', 'log', branch, '--pretty=oneline'],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout.splitlines()
+
+
+# Time each stage of a `gomp feature main` comparison once, in seconds
+def time_stages(src, dest):
+    times = {}
+
+    def timed(stage, function):
+        start = time.perf_counter()
+        result = function()
+        times[stage] = time.perf_counter() - start
+        return result
+
+    hashes = timed('resolve', lambda: resolve_branches([src, dest]))
+    logs = timed('load', lambda: [git_log(_hash) for _hash in hashes])
+    source, destination = timed(
+        'parse', lambda: [process_history(log) for log in logs]
+    )
+    _hash = timed(
+        'common_hash', lambda: find_first_common_hash(source, destination)
+    )
+    title_maps = timed(
+        'title_map',
+        lambda: (create_title_map(source), create_title_map(destination)),
+    )
+    side_by_side = timed(
+        'diff',
+        lambda: compute_side_by_side(
+            source, destination, _hash, title_maps=title_maps
+        ),
+    )
+    timed(
+        'render', lambda: list(format_side_by_side(side_by_side, NUM_COLS))
+    )
+    counts = {
+        'source_commits': len(source),
+        'destination_commits': len(destination),
+        'rows': len(side_by_side),
+    }
+    return times, counts
+
+
+def benchmark(path, repeat):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        runs = [time_stages('feature', 'main') for _ in range(repeat)]
+    finally:
+        os.chdir(cwd)
+    stages = {}
+    for stage in runs[0][0]:
+        samples = [times[stage] for times, _ in runs]
+        stages[stage] = {
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'max': max(samples),
+        }
+    return stages, runs[0][1]
+
+
+# Pairs of source and destination title lists of `count` titles each. A
+# `reword_ratio` fraction of the destination titles are reworded copies of a
+# source title (a tag or ticket id added, a word appended), the others are
+# unrelated.
+def generate_titles(count, reword_ratio, seed=0):
+    rng = random.Random(seed)
+    words = [
+        ''.join(
+            rng.choice('abcdefghijklmnopqrstuvwxyz')
+            for _ in range(rng.randint(3, 9))
+        )
+        for _ in range(5000)
+    ]
+
+    def title():
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(3, 8)))
+
+    source = [title() for _ in range(count)]
+    rewordings = [
+        '[backport] {}',
+        'ABC-{number}: {}',
+        '{} (#{number})',
+        '{} again',
+    ]
+    destination = []
+    reworded = 0
+    for number, _title in enumerate(source):
+        if rng.random() < reword_ratio:
+            reworded += 1
+            rewording = rng.choice(rewordings)
+            destination.append(rewording.format(_title, number=number))
+        else:
+            destination.append(title())
+    return source, destination, reworded
+
+
+# Time fuzzy title matching of generated titles, in seconds
+def benchmark_fuzzy(count, reword_ratio, repeat, seed=0):
+    source, destination, reworded = generate_titles(count, reword_ratio, seed)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matches = match_fuzzy_titles(source, destination, FUZZY_THRESHOLD)
+        samples.append(time.perf_counter() - start)
+    return {
+        'titles': count,
+        'reword_ratio': reword_ratio,
+        'seed': seed,
+        'repeat': repeat,
+        'reworded': reworded,
+        'matches': len(matches),
+        'correct_matches': sum(1 for i, j, _ in matches if i == j),
+        'seconds': {
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'max': max(samples),
+        },
+    }
+
+
+def gomp_version():
+    return run(
+        ['git', 'describe', '--always', '--dirty'],
+        stdout=PIPE,
+        universal_newlines=True,
+        check=False,
+        cwd=GOMP_ROOT,
+    ).stdout.strip()
+
+
+def process_commands():
+    parser = argparse.ArgumentParser(
+        description='Time each stage of gomp on generated histories'
+    )
+    parser.add_argument(
+        '--depth',
+        help='Number of shared commits, one benchmark per value',
+        nargs='+',
+        type=int,
+        default=[10000],
+    )
+    parser.add_argument(
+        '--divergence',
+        help='Number of commits on each branch after the fork',
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '--cherry-pick-ratio',
+        help='Fraction of feature commits cherry-picked from main',
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        '--duplicate-ratio',
+        help='Fraction of shared commits with a duplicated title',
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        '--repeat', help='Timed runs per history', type=int, default=3
+    )
+    parser.add_argument(
+        '--fuzzy-titles',
+        help='Number of titles on each side of the fuzzy matching benchmark, '
+        'one benchmark per value (none by default)',
+        nargs='+',
+        type=int,
+        default=[],
+    )
+    parser.add_argument(
+        '--reword-ratio',
+        help='Fraction of reworded titles in the fuzzy matching benchmark',
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--output', help='Write the JSON results to a file instead of stdout'
+    )
+    args = parser.parse_args()
+
+    results = {
+        'gomp': gomp_version(),
+        'python': platform.python_version(),
+        'git': run(
+            ['git', '--version'], stdout=PIPE, universal_newlines=True
+        ).stdout.strip(),
+        'benchmarks': [],
+    }
+    for depth in args.depth:
+        with tempfile.TemporaryDirectory() as path:
+            start = time.perf_counter()
+            generate_history(
+                path,
+                depth,
+                args.divergence,
+                args.cherry_pick_ratio,
+                args.duplicate_ratio,
+                args.seed,
+            )
+            generated = time.perf_counter() - start
+            stages, counts = benchmark(path, args.repeat)
+        results['benchmarks'].append(
+            {
+                'depth': depth,
+                'divergence': args.divergence,
+                'cherry_pick_ratio': args.cherry_pick_ratio,
+                'duplicate_ratio': args.duplicate_ratio,
+                'seed': args.seed,
+                'repeat': args.repeat,
+                'generate_seconds': generated,
+                'counts': counts,
+                'stages': stages,
+            }
+        )
+
+    results['fuzzy'] = [
+        benchmark_fuzzy(count, args.reword_ratio, args.repeat, args.seed)
+        for count in args.fuzzy_titles
+    ]
+
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    process_commands()
@@ -1,3 +1,4 @@
 #!/bin/bash
 
-mv .git test_history
\ No newline at end of file
+rm -rf .git/gomp-cache .git/objects/info
+mv .git test_history
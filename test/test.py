@@ -1,9 +1,73 @@
-from subprocess import run, PIPE
+from subprocess import run, Popen, PIPE
+import json
+import os
+import pty
+import sys
+import tempfile
+import time
 import unittest
 
+sys.path.insert(0, '..')
+from gomp.gomp import (
+    CommitCache,
+    HistoryComparison,
+    Repository,
+    Row,
+    Status,
+    align_rows,
+    diff_size_distance,
+    pair_rewrites,
+)
+
 # The number of columns to use during test recording and playback
 NUM_COLS = '80'
 GOMP_PATH = '../gomp/gomp.py'
+CLIENT_PATH = '../gomp/client.py'
+
+
+# Create branches with fast-import from (branch, start, title, path) commits,
+# each changing the file at `path`, optionally followed by the new content of
+# the file. Branches start from `start`, or continue from their previous
+# commit if it's None. The objects are kept out of the fixture repository, in
+# `objects`. Returns the environment to run git in.
+def import_commits(commits, objects):
+    env = dict(
+        os.environ,
+        GIT_OBJECT_DIRECTORY=objects,
+        GIT_ALTERNATE_OBJECT_DIRECTORIES=os.path.abspath('.git/objects'),
+    )
+    stream = ''
+    for number, (branch, start, _title, path, *content) in enumerate(commits):
+        stream += 'commit refs/heads/{}\n'.format(branch)
+        stream += 'committer Test <test@example.com> 0 +0000\n'
+        stream += 'data {}\n{}\n'.format(len(_title), _title)
+        if start is not None:
+            stream += 'from refs/heads/{}^0\n'.format(start)
+        content = content[0] if content else '{} {}\n'.format(branch, number)
+        stream += 'M 100644 inline {}\n'.format(path)
+        stream += 'data {}\n{}\n'.format(len(content), content)
+    run(
+        ['git', 'fast-import', '--quiet'],
+        input=stream,
+        universal_newlines=True,
+        env=env,
+        check=True,
+    )
+    return env
+
+
+# Start a daemon in the fixture repository (or a worktree of it, with its
+# git directory) and wait until it listens
+def start_daemon(timeout=30, cwd=None, git_dir='.git'):
+    daemon = Popen(['python3', os.path.abspath(GOMP_PATH), '--daemon'], cwd=cwd)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(os.path.join(git_dir, 'gomp-daemon.sock')):
+        if daemon.poll() is not None or time.monotonic() > deadline:
+            daemon.kill()
+            daemon.wait()
+            raise AssertionError('The gomp daemon did not start')
+        time.sleep(0.01)
+    return daemon
 
 
 class GOMPIntegrationTestCase(unittest.TestCase):
@@ -99,6 +163,1023 @@ class GOMPIntegrationTestCase(unittest.TestCase):
         f.close()
         self.assertEqual(gomp_output, expected_output)
 
+    def test_bounded_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--bounded',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_bounded_merge_multiple_commits(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'main-merge-target',
+                'main-merge-target~1',
+                '--bounded',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/merge_multiple_commits.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_patch_id_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--match',
+                'patch-id',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_cherry_mark_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--engine',
+                'cherry-mark',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_cherry_mark_merge_multiple_commits(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'main-merge-target',
+                'main-merge-target~1',
+                '--engine',
+                'cherry-mark',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/merge_multiple_commits.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_cherry_mark_same_commit(self):
+        outputs = [
+            run(
+                ['python3', GOMP_PATH, 'main', 'main', '--cols', NUM_COLS]
+                + engine,
+                stdout=PIPE,
+                universal_newlines=True,
+                check=False,
+            ).stdout
+            for engine in [[], ['--engine', 'cherry-mark']]
+        ]
+        self.assertEqual(outputs[1], outputs[0])
+
+    def test_warm_cache_feature_main(self):
+        for _ in range(2):
+            gomp_output = run(
+                ['python3', GOMP_PATH, 'feature', 'main', '--cols', NUM_COLS],
+                stdout=PIPE,
+                universal_newlines=True,
+                check=False,
+            ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_commit_cache_concurrent_saves(self):
+        directory = tempfile.TemporaryDirectory()
+        first = CommitCache(directory.name)
+        second = CommitCache(directory.name)
+        first.add('a' * 40, 1, [], 'First')
+        first.add_tip('a' * 40)
+        second.add('b' * 40, 2, ['a' * 40], 'Second')
+        second.add_tip('b' * 40)
+        # The second save must keep the records of the first one
+        self.assertTrue(first.save())
+        self.assertTrue(second.save())
+        first.close()
+        second.close()
+        cache = CommitCache(directory.name)
+        self.assertEqual(cache.get('a' * 40), (1, [], 'First', 0, ''))
+        self.assertEqual(cache.get('b' * 40), (2, ['a' * 40], 'Second', 0, ''))
+        self.assertEqual(cache.tips, ['b' * 40, 'a' * 40])
+        self.assertEqual(
+            [commit for commit, _ in cache.walk('b' * 40)],
+            [['b' * 40, 'Second'], ['a' * 40, 'First']],
+        )
+        self.assertIsNone(cache.walk('c' * 40))
+        cache.close()
+        directory.cleanup()
+
+    def test_commit_cache_saves_commits_once(self):
+        directory = tempfile.TemporaryDirectory()
+        data = os.path.join(directory.name, 'commits.dat')
+        sizes = []
+        for patch_id in [None, None, 'c' * 40, 'c' * 40]:
+            # A new cache every time, like the processes adding the history
+            # of a tip that was dropped from the tips
+            cache = CommitCache(directory.name)
+            cache.add('a' * 40, 1, [], 'First')
+            cache.add('b' * 40, 2, ['a' * 40], 'Second')
+            if patch_id is not None:
+                cache.set_patch_id('b' * 40, patch_id)
+            cache.add_tip('b' * 40)
+            self.assertTrue(cache.save())
+            cache.close()
+            sizes.append(os.path.getsize(data))
+        # Only gaining a patch-id appends a record again
+        self.assertEqual(sizes[0], sizes[1])
+        self.assertGreater(sizes[2], sizes[1])
+        self.assertEqual(sizes[2], sizes[3])
+        cache = CommitCache(directory.name)
+        self.assertEqual(cache.patch_id('b' * 40), 'c' * 40)
+        cache.close()
+        directory.cleanup()
+
+    def test_no_cache_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--no-cache',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_missing_branch(self):
+        gomp_output = run(
+            ['python3', GOMP_PATH, 'feature', 'missing', '--cols', NUM_COLS],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/missing_branch.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_native_feature_main(self):
+        run(['git', 'commit-graph', 'write', '--reachable'], check=True)
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--native',
+                '--no-cache',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_native_without_commit_graph(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'main-merge-target',
+                'main-merge-target~1',
+                '--native',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/merge_multiple_commits.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_library_api(self):
+        repository = Repository(cache=False)
+        comparison = HistoryComparison('feature', 'main', repository).load()
+        self.assertEqual(comparison.find_common_hash()[0:7], '2349725')
+        pairs = comparison.side_by_side()
+        self.assertEqual(len(pairs), 11)
+        left, right = pairs[2]
+        self.assertEqual(left.hash[0:7], '7338c7e')
+        self.assertEqual(left.title, 'Commit d')
+        self.assertEqual(left.status, Status.src_new)
+        self.assertEqual(right.status, Status.similar)
+        self.assertEqual(pairs[0][0], None)
+        # Histories are shared, not reloaded, by comparisons on the repository
+        other = HistoryComparison('feature', 'main~1', repository).load()
+        self.assertIs(other.source_history, comparison.source_history)
+
+    def test_library_fast_forward(self):
+        run(['git', 'branch', 'advancing', 'main~2'], check=True)
+        repository = Repository(cache=False)
+        HistoryComparison('feature', 'advancing', repository).side_by_side()
+        run(['git', 'branch', '-f', 'advancing', 'main'], check=True)
+        comparison = HistoryComparison('feature', 'advancing', repository)
+        pairs = comparison.load().side_by_side()
+        run(['git', 'update-ref', '-d', 'refs/heads/advancing'], check=True)
+        # Only the two new commits were read, on top of the previous history
+        base, count = repository.extensions[comparison.destination_hash]
+        self.assertEqual(count, 2)
+        self.assertIn(base, repository.histories)
+        expected = HistoryComparison('feature', 'main', Repository(cache=False))
+        self.assertEqual(pairs, expected.load().side_by_side())
+
+    def test_matrix(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                '--matrix',
+                'main',
+                'feature',
+                'main-forked',
+                'main-merge-target',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/matrix.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_matrix_rejects_unsupported_options(self):
+        for options in (
+            ['--views', '--format', 'json'],
+            ['--stat'],
+            ['--recut'],
+            ['--align', '--key'],
+            ['--engine', 'dag'],
+            ['--fuzzy'],
+        ):
+            gomp = run(
+                ['python3', GOMP_PATH, '--matrix', 'main', 'feature']
+                + options,
+                stdout=PIPE,
+                stderr=PIPE,
+                universal_newlines=True,
+                check=False,
+            )
+            self.assertEqual(gomp.returncode, 2)
+            self.assertEqual(gomp.stdout, '')
+
+    def test_profile_environment(self):
+        gomp = run(
+            ['python3', GOMP_PATH, 'feature', 'main', '--cols', NUM_COLS],
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+            env=dict(os.environ, GOMP_PROFILE='true'),
+            check=False,
+        )
+        # Truthy values report on stderr, they aren't file names
+        self.assertIn('Subprocess', gomp.stderr)
+        self.assertFalse(os.path.exists('true'))
+
+    def test_profile(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--cols',
+                NUM_COLS,
+                '--profile',
+                'profile.json',
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+        f = open('profile.json', 'r')
+        profile = json.load(f)
+        f.close()
+        os.remove('profile.json')
+        self.assertEqual(profile['stages']['load']['commits'], 20)
+        self.assertEqual(profile['subprocesses']['git cat-file']['count'], 1)
+        self.assertGreater(profile['peak_memory'], 0)
+
+    def test_stat_feature_main(self):
+        gomp_output = run(
+            ['python3', GOMP_PATH, 'feature', 'main', '--stat'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/stat_feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_stat_rejects_unsupported_options(self):
+        for options in (
+            ['--recut'],
+            ['--align'],
+            ['--engine', 'dag'],
+            ['--fuzzy'],
+            ['--bounded'],
+            ['--match', 'patch-id'],
+        ):
+            gomp = run(
+                ['python3', GOMP_PATH, 'feature', 'main', '--stat'] + options,
+                stdout=PIPE,
+                stderr=PIPE,
+                universal_newlines=True,
+                check=False,
+            )
+            self.assertEqual(gomp.returncode, 2)
+            self.assertEqual(gomp.stdout, '')
+
+    def test_stat_json_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--stat',
+                '--format',
+                'json',
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/stat_feature_main.json', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_pager_quits_early(self):
+        # Run on a terminal so that output goes through the pager
+        master, slave = pty.openpty()
+        env = dict(os.environ, GIT_PAGER='head -n 3')
+        gomp = Popen(
+            ['python3', GOMP_PATH, 'feature', 'main', '--cols', NUM_COLS],
+            stdout=slave,
+            stderr=PIPE,
+            env=env,
+        )
+        os.close(slave)
+        output = b''
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                break
+            if not data:
+                break
+            output += data
+        os.close(master)
+        errors = gomp.communicate()[1]
+        self.assertEqual(gomp.returncode, 0)
+        self.assertEqual(errors, b'')
+        self.assertEqual(len(output.splitlines()), 3)
+
+    def test_ndjson_feature_main(self):
+        gomp_output = run(
+            ['python3', GOMP_PATH, 'feature', 'main', '--format', 'ndjson'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/feature_main.ndjson', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_json_recut_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--recut',
+                '--format',
+                'json',
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/recut_feature_main.json', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_recut_predict_conflicts(self):
+        objects = tempfile.TemporaryDirectory()
+        env = import_commits(
+            [
+                ('conflict-dest', 'main', 'Change README on dest', 'README.md'),
+                ('conflict-src', 'feature', 'Change README', 'README.md'),
+                ('conflict-src', None, 'Add notes', 'notes.txt'),
+                ('conflict-src', None, 'Change README again', 'README.md'),
+            ],
+            objects.name,
+        )
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'conflict-src',
+                'conflict-dest',
+                '--no-cache',
+                '--recut',
+                '--predict-conflicts',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            env=env,
+            check=False,
+        ).stdout
+        for branch in ['conflict-src', 'conflict-dest']:
+            run(
+                ['git', 'update-ref', '-d', 'refs/heads/' + branch], check=True
+            )
+        objects.cleanup()
+        f = open('expected_output/recut_predict_conflicts.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_fuzzy_reworded_cherry_pick(self):
+        objects = tempfile.TemporaryDirectory()
+        env = import_commits(
+            [
+                ('fuzzy-dest', 'main', '[backport] Fix parser crash', 'a.c'),
+                ('fuzzy-dest', None, 'Update changelog', 'CHANGELOG'),
+                ('fuzzy-src', 'feature', 'ABC-42: Fix parser crash', 'b.c'),
+                ('fuzzy-src', None, 'Add parser tests', 'test.c'),
+            ],
+            objects.name,
+        )
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'fuzzy-src',
+                'fuzzy-dest',
+                '--no-cache',
+                '--fuzzy',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            env=env,
+            check=False,
+        ).stdout
+        for branch in ['fuzzy-src', 'fuzzy-dest']:
+            run(
+                ['git', 'update-ref', '-d', 'refs/heads/' + branch], check=True
+            )
+        objects.cleanup()
+        f = open('expected_output/fuzzy_reworded_cherry_pick.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_contained_in_feature_main_merge_target(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main-merge-target',
+                '--contained-in',
+                'main-forked',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open(
+            'expected_output/contained_in_feature_main_merge_target.txt', 'r'
+        )
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_contained_in_first_parent(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'main-merge-target',
+                'main',
+                '--first-parent',
+                '--contained-in',
+                '*',
+                '--cols',
+                NUM_COLS,
+                '--profile',
+                'profile.json',
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('profile.json', 'r')
+        profile = json.load(f)
+        f.close()
+        os.remove('profile.json')
+        f = open('expected_output/contained_in_first_parent.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+        # Rows below the fork point of the folded branch are still found by
+        # the single walk, not asked about one by one
+        subprocesses = profile['subprocesses']
+        self.assertEqual(subprocesses['git for-each-ref']['count'], 1)
+        self.assertEqual(subprocesses['git rev-list']['count'], 2)
+
+    def test_rewrite_rebased_branch(self):
+        objects = tempfile.TemporaryDirectory()
+        env = import_commits(
+            [
+                ('rewrite-old', 'main', 'Add parser', 'parser.c', 'parser\n'),
+                ('rewrite-old', None, 'Fix lexer', 'lexer.c', 'lexer\n'),
+                ('rewrite-old', None, 'Update docs', 'README', 'docs\n'),
+                ('rewrite-old', None, 'Add tests', 'test.c', 'tests\n'),
+                ('rewrite-new', 'main', 'Add tests', 'test.c', 'tests\nmore\n'),
+                ('rewrite-new', None, 'Add parser', 'parser.c', 'parser\n'),
+                ('rewrite-new', None, 'lexer: Fix crash', 'lexer.c', 'lexer\n'),
+                ('rewrite-new', None, 'Add CI config', 'ci.yml', 'ci\n'),
+            ],
+            objects.name,
+        )
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'rewrite-old',
+                'rewrite-new',
+                '--rewrite',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            env=env,
+            check=False,
+        ).stdout
+        for branch in ['rewrite-old', 'rewrite-new']:
+            run(
+                ['git', 'update-ref', '-d', 'refs/heads/' + branch], check=True
+            )
+        objects.cleanup()
+        f = open('expected_output/rewrite_rebased_branch.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_rewrite_merges_without_patch_id(self):
+        objects = tempfile.TemporaryDirectory()
+        env = import_commits(
+            [
+                ('rewrite-topic-old', 'main', 'Add parser', 'a.c', 'a\n'),
+                ('rewrite-topic-new', 'main', 'Add parser', 'a.c', 'a\nb\n'),
+            ],
+            objects.name,
+        )
+        for role in ['AUTHOR', 'COMMITTER']:
+            env['GIT_{}_NAME'.format(role)] = 'Test'
+            env['GIT_{}_EMAIL'.format(role)] = 'test@example.com'
+        # Merges of different topics under the same title
+        for branch in ['old', 'new']:
+            merge = run(
+                [
+                    'git',
+                    'commit-tree',
+                    '-p',
+                    'main',
+                    '-p',
+                    'rewrite-topic-' + branch,
+                    '-m',
+                    'Merge topic',
+                    'rewrite-topic-' + branch + '^{tree}',
+                ],
+                stdout=PIPE,
+                universal_newlines=True,
+                env=env,
+                check=True,
+            ).stdout.strip()
+            run(
+                ['git', 'update-ref', 'refs/heads/rewrite-' + branch, merge],
+                env=env,
+                check=True,
+            )
+        records = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'rewrite-old',
+                'rewrite-new',
+                '--rewrite',
+                '--format',
+                'ndjson',
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            env=env,
+            check=False,
+        ).stdout.splitlines()
+        for branch in ['old', 'new', 'topic-old', 'topic-new']:
+            run(
+                ['git', 'update-ref', '-d', 'refs/heads/rewrite-' + branch],
+                check=True,
+            )
+        objects.cleanup()
+        merges = [
+            record
+            for record in map(json.loads, records)
+            if record['title'] == 'Merge topic'
+        ]
+        # Neither merge has a patch-id, their diffs tell them apart
+        self.assertEqual(
+            [record['rewrite'] for record in merges], ['content-changed'] * 2
+        )
+
+    def test_deepen_shallow_clone(self):
+        directory = tempfile.TemporaryDirectory()
+        remote = os.path.join(directory.name, 'remote.git')
+        clone = os.path.join(directory.name, 'clone')
+        run(['git', 'clone', '--quiet', '--bare', '.', remote], check=True)
+        run(
+            [
+                'git',
+                'clone',
+                '--quiet',
+                '--depth',
+                '1',
+                '--no-single-branch',
+                'file://' + remote,
+                clone,
+            ],
+            check=True,
+        )
+        for branch in ['feature', 'main']:
+            run(
+                ['git', 'branch', '--quiet', branch, 'origin/' + branch],
+                cwd=clone,
+                check=True,
+            )
+        gomp_output = run(
+            [
+                'python3',
+                os.path.abspath(GOMP_PATH),
+                'feature',
+                'main',
+                '--deepen',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            cwd=clone,
+            check=False,
+        ).stdout
+        directory.cleanup()
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_first_parent_merge_target_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'main-merge-target',
+                'main',
+                '--first-parent',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/first_parent_merge_target_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_align_feature_main(self):
+        gomp_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'feature',
+                'main',
+                '--align',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        f = open('expected_output/align_feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+
+    def test_align_moved_commits(self):
+        source = [
+            Row('a' * 40, 'A', Status.similar, False),
+            Row('b' * 40, 'B', Status.similar, False),
+            Row('c' * 40, 'C', Status.similar, False),
+            Row('0' * 40, 'Base', Status.common, False),
+        ]
+        destination = [
+            Row('d' * 40, 'C', Status.similar, False),
+            Row('e' * 40, 'A', Status.similar, False),
+            Row('f' * 40, 'B', Status.similar, False),
+            Row('0' * 40, 'Base', Status.common, False),
+        ]
+        pairs = [
+            tuple(row and (row.title, row.status) for row in pair)
+            for pair in align_rows(source, destination)
+        ]
+        # Only C moved, A and B stay aligned
+        self.assertEqual(
+            pairs,
+            [
+                (None, ('C', Status.moved)),
+                (('A', Status.similar), ('A', Status.similar)),
+                (('B', Status.similar), ('B', Status.similar)),
+                (('C', Status.moved), None),
+                (('Base', Status.common), ('Base', Status.common)),
+            ],
+        )
+
+    def test_rewrite_duplicate_titles(self):
+        old = [
+            ('a' * 40, 'Fix typo', {'a.c': 1}),
+            ('b' * 40, 'Fix typo', {'b.c': 3, 'c.c': 1}),
+        ]
+        new = [
+            ('c' * 40, 'Fix typo', {'b.c': 3, 'c.c': 2}),
+            ('d' * 40, 'Fix typo', {'a.c': 1}),
+        ]
+        # Commits sharing a title are told apart by the size of their diffs
+        self.assertEqual(pair_rewrites(old, new, {}), {0: 1, 1: 0})
+
+    def test_rewrite_zero_line_changes(self):
+        # Empty files and mode changes change no line, but still count
+        self.assertEqual(diff_size_distance({'a.temp': 0}, {'b.temp': 0}), 1.0)
+        self.assertEqual(diff_size_distance({'a.temp': 0}, {'a.temp': 0}), 0.0)
+        self.assertEqual(
+            diff_size_distance({'a.c': 0, 'b.c': 1}, {'a.c': 0}), 0.5
+        )
+        old = [('a' * 40, 'Commit a', {'a.temp': 0})]
+        new = [('b' * 40, 'Commit b', {'b.temp': 0})]
+        self.assertEqual(pair_rewrites(old, new, {}), {})
+
+    def test_daemon_feature_main(self):
+        run(['git', 'branch', 'daemon-feature', 'feature'], check=True)
+        daemon = start_daemon()
+        self.assertIsNone(daemon.poll())
+        gomp_output = run(
+            ['python3', CLIENT_PATH, 'feature', 'main', '--cols', NUM_COLS],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        # Moving a branch invalidates what the daemon resolved it to
+        before_output = run(
+            [
+                'python3',
+                CLIENT_PATH,
+                'daemon-feature',
+                'main',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        run(['git', 'branch', '-f', 'daemon-feature', 'main'], check=True)
+        after_output = run(
+            [
+                'python3',
+                CLIENT_PATH,
+                'daemon-feature',
+                'main',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        expected_after_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'daemon-feature',
+                'main',
+                '--no-daemon',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        # Pseudo-refs aren't watched, they are resolved again on every request
+        orig_head = run(
+            ['git', 'rev-parse', 'ORIG_HEAD'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+        run(['git', 'update-ref', 'ORIG_HEAD', 'feature'], check=True)
+        run(
+            ['python3', CLIENT_PATH, 'ORIG_HEAD', 'main', '--cols', NUM_COLS],
+            stdout=PIPE,
+            check=False,
+        )
+        run(['git', 'update-ref', 'ORIG_HEAD', 'main-forked'], check=True)
+        pseudo_ref_output = run(
+            ['python3', CLIENT_PATH, 'ORIG_HEAD', 'main', '--cols', NUM_COLS],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        expected_pseudo_ref_output = run(
+            [
+                'python3',
+                GOMP_PATH,
+                'ORIG_HEAD',
+                'main',
+                '--no-daemon',
+                '--cols',
+                NUM_COLS,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=False,
+        ).stdout
+        daemon.terminate()
+        daemon.wait()
+        run(['git', 'update-ref', 'ORIG_HEAD', orig_head], check=True)
+        run(
+            ['git', 'update-ref', '-d', 'refs/heads/daemon-feature'], check=True
+        )
+        f = open('expected_output/feature_main.txt', 'r')
+        expected_output = f.read()
+        f.close()
+        self.assertEqual(gomp_output, expected_output)
+        self.assertNotEqual(before_output, after_output)
+        self.assertEqual(after_output, expected_after_output)
+        self.assertEqual(pseudo_ref_output, expected_pseudo_ref_output)
+        self.assertFalse(os.path.exists('.git/gomp-daemon.sock'))
+
+    def test_daemon_linked_worktree(self):
+        directory = tempfile.TemporaryDirectory()
+        worktree = os.path.join(directory.name, 'worktree')
+        run(
+            ['git', 'worktree', 'add', '-q', '--detach', worktree, 'feature'],
+            check=True,
+        )
+        # Without gomp next to it, the client can only be answered by the
+        # daemon
+        client = os.path.join(directory.name, 'client.py')
+        with open(CLIENT_PATH, 'r') as source, open(client, 'w') as copy:
+            copy.write(source.read())
+        try:
+            git_dir = run(
+                ['git', 'rev-parse', '--absolute-git-dir'],
+                stdout=PIPE,
+                universal_newlines=True,
+                cwd=worktree,
+                check=True,
+            ).stdout.strip()
+            daemon = start_daemon(cwd=worktree, git_dir=git_dir)
+            command = ['python3', client, 'HEAD', 'main', '--cols', NUM_COLS]
+            before_output = run(
+                command,
+                stdout=PIPE,
+                universal_newlines=True,
+                cwd=worktree,
+                check=False,
+            ).stdout
+            # The daemon watches the worktree's own HEAD
+            run(
+                ['git', 'checkout', '--quiet', '--detach', 'main-forked'],
+                cwd=worktree,
+                check=True,
+            )
+            after_output = run(
+                command,
+                stdout=PIPE,
+                universal_newlines=True,
+                cwd=worktree,
+                check=False,
+            ).stdout
+            expected_after_output = run(
+                [
+                    'python3',
+                    os.path.abspath(GOMP_PATH),
+                    'HEAD',
+                    'main',
+                    '--no-daemon',
+                    '--cols',
+                    NUM_COLS,
+                ],
+                stdout=PIPE,
+                universal_newlines=True,
+                cwd=worktree,
+                check=False,
+            ).stdout
+            daemon.terminate()
+            daemon.wait()
+        finally:
+            run(['git', 'worktree', 'remove', '--force', worktree], check=True)
+            directory.cleanup()
+        self.assertNotEqual(before_output, after_output)
+        self.assertEqual(after_output, expected_after_output)
+
     def test_help(self):
         gomp_output = run(
             ['python3', GOMP_PATH, '-h'],